@@ -3,6 +3,7 @@ import streamlit.components.v1 as components
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+from contextlib import contextmanager
 from datetime import date, datetime
 from pathlib import Path
 import json
@@ -18,6 +19,13 @@ from docx.oxml.ns import qn
 import toml
 import sqlite3
 import os
+import queue
+from feedback_queue import FeedbackQueue
+from migrations import (DELETE_PATIENT_SESSIONS_SQL, LATEST_BIG5_SQL, PATIENT_CONDITION_FILTER, PATIENT_COUNT_SQL,
+                        PATIENT_DETAIL_BIG5_SQL, PATIENT_DETAIL_SESSIONS_SQL, PATIENT_FEEDBACK_COUNTS_JOIN,
+                        PATIENT_FEEDBACK_SQL, PATIENT_NAME_FILTER, PATIENT_PAGE_SQL, PATIENT_RECOMMENDATIONS_SQL,
+                        PATIENT_ROWS_SQL, PATIENT_SESSION_COUNTS_JOIN, PATIENT_SESSIONS_SQL, migrate, sql_casefold)
+from shared_model import SharedTheraMuse
 
 # Load color schema from config
 def load_color_schema():
@@ -789,308 +797,331 @@ def get_database_path():
         # Local development path
         return Path("/home/spectre-rosamund/Documents/ubuntu/thera/theramuse_app/theramuse.db")
 
-# PATIENT DATABASE FUNCTIONS
-def get_patient_db_connection():
-    """Get connection to patient database"""
-    import tempfile
-    import os
+# SHARED MODEL
+@st.cache_resource(show_spinner=False)
+def get_shared_theramuse() -> SharedTheraMuse:
+    """Get the single TheraMuse instance for this server process"""
+    return SharedTheraMuse(TheraMuse(db_path=str(get_database_path())))
+
+# FEEDBACK QUEUE
+@st.cache_resource(show_spinner=False)
+def get_feedback_queue() -> FeedbackQueue:
+    """Get the feedback queue for this server process"""
+    return FeedbackQueue(get_shared_theramuse())
+
+# PATIENT DATABASE CONNECTIONS
+def _like_contains(text: str) -> str:
+    """LIKE pattern (for ESCAPE '\\') matching text anywhere, wildcards taken literally"""
+    escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{escaped}%"
+
+class PatientDBPool:
+    """Pool of pre-configured connections to the patient database.
+
+    Schema migrations run once when the pool is created. Every connection is
+    opened once with WAL journaling and the performance pragmas below, then
+    reused across page renders instead of reconnecting on every query.
+    """
 
-    # Get the correct database path
-    db_path = get_database_path()
-
-    # Ensure the directory exists
-    db_path.parent.mkdir(parents=True, exist_ok=True)
-
-    conn = sqlite3.connect(str(db_path))
-    cursor = conn.cursor()
-
-    # Create patients table if it doesn't exist
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            age INTEGER,
-            sex TEXT,
-            birthplace_city TEXT,
-            birthplace_country TEXT,
-            favorite_genre TEXT,
-            favorite_musician TEXT,
-            favorite_season TEXT,
-            instruments TEXT,
-            natural_elements TEXT,
-            condition TEXT,
-            difficulty_sleeping BOOLEAN,
-            trouble_remembering BOOLEAN,
-            forgets_everyday_things BOOLEAN,
-            difficulty_recalling_old_memories BOOLEAN,
-            memory_worse_than_year_ago BOOLEAN,
-            visited_mental_health_professional BOOLEAN,
-            extraversion REAL,
-            agreeableness REAL,
-            conscientiousness REAL,
-            neuroticism REAL,
-            openness REAL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # Create sessions table if it doesn't exist
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS therapy_sessions (
-            id TEXT PRIMARY KEY,
-            patient_id TEXT,
-            session_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            recommendations_count INTEGER,
-            session_data TEXT,
-            FOREIGN KEY (patient_id) REFERENCES patients (id)
-        )
-    ''')
+    PRAGMAS = (
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
+    )
 
-    # Check if table exists and has correct structure
-    cursor.execute("PRAGMA table_info(patients)")
-    columns = cursor.fetchall()
+    def __init__(self, db_path: Path, size: int = 4):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._pool = queue.LifoQueue(maxsize=size)
+        migrate(self.db_path)
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        self._release(conn)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.db_path), timeout=5.0, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        # SQLite's LIKE and lower() only fold ASCII; name search needs Unicode
+        conn.create_function('casefold', 1, sql_casefold, deterministic=True)
+        return conn
+
+    def _release(self, conn: sqlite3.Connection):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; commits on success, rolls back on error, then returns it to the pool"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            self._release(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
 
-    if not columns:
-        # Table doesn't exist, commit the creation
-        conn.commit()
+@st.cache_resource(show_spinner=False)
+def get_patient_db_pool() -> PatientDBPool:
+    """Get the patient database connection pool for this server process"""
+    return PatientDBPool(get_database_path())
 
-    return conn
+def patient_db():
+    """Borrow a pooled patient database connection: ``with patient_db() as conn:``"""
+    return get_patient_db_pool().connection()
 
+# PATIENT DATABASE FUNCTIONS
 def save_patient_to_database(patient_info: Dict, big5_scores: Dict, recommendations: Dict, session_id: str):
     """Save patient information to database"""
-    conn = get_patient_db_connection()
-    cursor = conn.cursor()
-
     patient_id = f"patient_{datetime.now().strftime('%Y%m%d%H%M%S')}"
 
-    # Insert patient data
-    cursor.execute('''
-        INSERT OR REPLACE INTO patients (
-            id, name, age, sex, birthplace_city, birthplace_country,
-            favorite_genre, favorite_musician, favorite_season,
-            instruments, natural_elements, condition,
-            difficulty_sleeping, trouble_remembering, forgets_everyday_things,
-            difficulty_recalling_old_memories, memory_worse_than_year_ago,
-            visited_mental_health_professional, extraversion, agreeableness,
-            conscientiousness, neuroticism, openness, updated_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        patient_id,
-        patient_info.get('name', 'Anonymous'),
-        patient_info.get('age', 0),
-        patient_info.get('sex', ''),
-        patient_info.get('birthplace_city', ''),
-        patient_info.get('birthplace_country', ''),
-        patient_info.get('favorite_genre', ''),
-        patient_info.get('favorite_musician', ''),
-        patient_info.get('favorite_season', ''),
-        json.dumps(patient_info.get('instruments', [])),
-        json.dumps(patient_info.get('natural_elements', [])),
-        patient_info.get('condition', ''),
-        patient_info.get('difficulty_sleeping', False),
-        patient_info.get('trouble_remembering', False),
-        patient_info.get('forgets_everyday_things', False),
-        patient_info.get('difficulty_recalling_old_memories', False),
-        patient_info.get('memory_worse_than_year_ago', False),
-        patient_info.get('visited_mental_health_professional', False),
-        big5_scores.get('extraversion', 0),
-        big5_scores.get('agreeableness', 0),
-        big5_scores.get('conscientiousness', 0),
-        big5_scores.get('neuroticism', 0),
-        big5_scores.get('openness', 0),
-        datetime.now()
-    ))
+    with patient_db() as conn:
+        cursor = conn.cursor()
 
-    # Insert session data
-    cursor.execute('''
-        INSERT INTO therapy_sessions (
-            id, patient_id, recommendations_count, session_data
-        ) VALUES (?, ?, ?, ?)
-    ''', (
-        session_id,
-        patient_id,
-        recommendations.get('total_songs', 0),
-        json.dumps(recommendations)
-    ))
+        # Insert patient data
+        cursor.execute('''
+            INSERT OR REPLACE INTO patients (
+                patient_id, name, age, sex, birthplace_city, birthplace_country,
+                favorite_genre, favorite_musician, favorite_season,
+                instruments, natural_elements, condition,
+                difficulty_sleeping, trouble_remembering, forgets_everyday_things,
+                difficulty_recalling_old_memories, memory_worse_than_year_ago,
+                visited_mental_health_professional, extraversion, agreeableness,
+                conscientiousness, neuroticism, openness, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            patient_id,
+            patient_info.get('name', 'Anonymous'),
+            patient_info.get('age', 0),
+            patient_info.get('sex', ''),
+            patient_info.get('birthplace_city', ''),
+            patient_info.get('birthplace_country', ''),
+            patient_info.get('favorite_genre', ''),
+            patient_info.get('favorite_musician', ''),
+            patient_info.get('favorite_season', ''),
+            json.dumps(patient_info.get('instruments', [])),
+            json.dumps(patient_info.get('natural_elements', [])),
+            patient_info.get('condition', ''),
+            patient_info.get('difficulty_sleeping', False),
+            patient_info.get('trouble_remembering', False),
+            patient_info.get('forgets_everyday_things', False),
+            patient_info.get('difficulty_recalling_old_memories', False),
+            patient_info.get('memory_worse_than_year_ago', False),
+            patient_info.get('visited_mental_health_professional', False),
+            big5_scores.get('extraversion', 0),
+            big5_scores.get('agreeableness', 0),
+            big5_scores.get('conscientiousness', 0),
+            big5_scores.get('neuroticism', 0),
+            big5_scores.get('openness', 0),
+            datetime.now()
+        ))
+
+        # Insert session data
+        cursor.execute('''
+            INSERT INTO therapy_sessions (
+                id, patient_id, recommendations_count, session_data
+            ) VALUES (?, ?, ?, ?)
+        ''', (
+            session_id,
+            patient_id,
+            recommendations.get('total_songs', 0),
+            json.dumps(recommendations)
+        ))
 
-    conn.commit()
-    conn.close()
     return patient_id
 
 def get_all_patients():
     """Get all patients from database with Big Five scores and reinforcement learning"""
-    conn = get_patient_db_connection()
-    cursor = conn.cursor()
-
-    try:
-        # First try the enhanced schema with id column
-        cursor.execute('''
-            SELECT p.id, p.name, p.age, p.condition, p.created_at,
-                   p.extraversion, p.agreeableness, p.conscientiousness,
-                   p.neuroticism, p.openness, p.reinforcement_learning
-            FROM patients p
-            ORDER BY p.created_at DESC
-        ''')
-        patients = cursor.fetchall()
-        conn.close()
-        return patients
-    except sqlite3.OperationalError as e:
-        # If the enhanced schema doesn't exist, try the basic schema
-        if "no such column: p.id" in str(e):
-            try:
-                cursor.execute('''
-                    SELECT p.patient_id, p.name, p.age, p.condition, p.created_at,
-                           0 as extraversion, 0 as agreeableness, 0 as conscientiousness,
-                           0 as neuroticism, 0 as openness, 0 as reinforcement_learning
-                    FROM patients p
-                    ORDER BY p.created_at DESC
-                ''')
-                patients = cursor.fetchall()
-                conn.close()
-                return patients
-            except sqlite3.Error as e2:
-                st.error(f"Database query error (basic schema): {str(e2)}")
-                conn.close()
-                return []
-        else:
+    with patient_db() as conn:
+        try:
+            # Latest Big Five row per patient, falling back to the scores saved with the patient
+            return conn.execute('''
+                SELECT p.patient_id, p.name, p.age, p.condition, p.created_at,
+                       COALESCE(b.extraversion, p.extraversion, 0),
+                       COALESCE(b.agreeableness, p.agreeableness, 0),
+                       COALESCE(b.conscientiousness, p.conscientiousness, 0),
+                       COALESCE(b.neuroticism, p.neuroticism, 0),
+                       COALESCE(b.openness, p.openness, 0),
+                       COALESCE(b.reinforcement_learning, 0)
+                FROM patients p
+                LEFT JOIN (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY patient_id ORDER BY created_at DESC, id DESC) AS rn
+                    FROM big5_scores
+                ) b ON b.patient_id = p.patient_id AND b.rn = 1
+                ORDER BY p.created_at DESC
+            ''').fetchall()
+        except sqlite3.Error as e:
             st.error(f"Database query error: {str(e)}")
-            conn.close()
             return []
-    except sqlite3.Error as e:
-        st.error(f"Database query error: {str(e)}")
-        conn.close()
-        return []
 
 def get_patient_details(patient_id: str):
     """Get detailed information for a specific patient with Big Five scores and reinforcement learning"""
-    conn = get_patient_db_connection()
-    cursor = conn.cursor()
+    with patient_db() as conn:
+        cursor = conn.cursor()
 
-    try:
-        # Try to get patient with enhanced schema first
         try:
-            cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
-            patient = cursor.fetchone()
-        except sqlite3.OperationalError:
-            # Fall back to basic schema
             cursor.execute('SELECT * FROM patients WHERE patient_id = ?', (patient_id,))
             patient = cursor.fetchone()
 
-        # Get Big Five scores with reinforcement learning
-        cursor.execute('''
-            SELECT * FROM big5_scores
-            WHERE patient_id = ?
-            ORDER BY created_at DESC
-            LIMIT 1
-        ''', (patient_id,))
-        big5_scores = cursor.fetchone()
-
-        cursor.execute('SELECT * FROM therapy_sessions WHERE patient_id = ? ORDER BY session_date DESC', (patient_id,))
-        sessions = cursor.fetchall()
-
-        # Combine patient data with Big Five scores if available
-        if patient and big5_scores:
-            patient = list(patient) + list(big5_scores[2:])  # Skip patient_id and session_id from big5_scores
-
-        conn.close()
-        return patient, sessions
-    except sqlite3.Error as e:
-        st.error(f"Database query error: {str(e)}")
-        conn.close()
-        return None, []
+            # Get Big Five scores with reinforcement learning
+            cursor.execute(PATIENT_DETAIL_BIG5_SQL, (patient_id,))
+            big5_scores = cursor.fetchone()
+
+            cursor.execute(PATIENT_DETAIL_SESSIONS_SQL, (patient_id,))
+            sessions = cursor.fetchall()
+
+            # Combine patient data with Big Five scores if available
+            if patient and big5_scores:
+                patient = list(patient) + list(big5_scores[2:])  # Skip patient_id and session_id from big5_scores
+
+            return patient, sessions
+        except sqlite3.Error as e:
+            st.error(f"Database query error: {str(e)}")
+            return None, []
 
 def delete_patient(patient_id: str):
     """Delete a patient from database"""
-    conn = get_patient_db_connection()
-    cursor = conn.cursor()
-
-    cursor.execute('DELETE FROM therapy_sessions WHERE patient_id = ?', (patient_id,))
+    with patient_db() as conn:
+        cursor = conn.cursor()
 
-    # Try both possible column names
-    try:
-        cursor.execute('DELETE FROM patients WHERE id = ?', (patient_id,))
-    except sqlite3.OperationalError:
+        cursor.execute(DELETE_PATIENT_SESSIONS_SQL, (patient_id,))
         cursor.execute('DELETE FROM patients WHERE patient_id = ?', (patient_id,))
 
-    conn.commit()
-    conn.close()
+def get_comprehensive_patient_data(patient_ids: Optional[List[str]] = None):
+    """Get comprehensive patient data with therapy recommendations.
 
-def get_comprehensive_patient_data():
-    """Get comprehensive patient data with therapy recommendations"""
-    conn = get_patient_db_connection()
-    cursor = conn.cursor()
+    Loads every child table with one set-based query each and groups the rows
+    in Python, so the number of queries does not grow with the number of
+    patients. ``patient_ids`` limits the load to those patients, in that order.
+    """
+    with patient_db() as conn:
+        cursor = conn.cursor()
 
-    try:
-        # Get basic patient info with backward compatibility
         try:
-            cursor.execute('''
-                SELECT id, name, age, condition, created_at
-                FROM patients ORDER BY created_at DESC
-            ''')
-            patients = cursor.fetchall()
-            id_col = "id"
-        except sqlite3.OperationalError:
-            cursor.execute('''
-                SELECT patient_id, name, age, condition, created_at
-                FROM patients ORDER BY created_at DESC
-            ''')
+            if patient_ids is None:
+                where, params = '', ()
+            elif not patient_ids:
+                return []
+            else:
+                where = f"WHERE patient_id IN ({', '.join('?' * len(patient_ids))})"
+                params = tuple(patient_ids)
+
+            # Get basic patient info; a requested page is put in the caller's order below
+            query = PATIENT_ROWS_SQL.format(where=where)
+            if patient_ids is None:
+                query += " ORDER BY created_at DESC"
+            cursor.execute(query, params)
             patients = cursor.fetchall()
-            id_col = "patient_id"
-
-        patient_data = []
+            if patient_ids is not None:
+                order = {patient_id: i for i, patient_id in enumerate(patient_ids)}
+                patients.sort(key=lambda p: order[p[0]])
+
+            sessions = {}
+            cursor.execute(PATIENT_SESSIONS_SQL.format(where=where), params)
+            for patient_id, *session in cursor:
+                sessions.setdefault(patient_id, []).append(tuple(session))
+
+            recommendations = {}
+            cursor.execute(PATIENT_RECOMMENDATIONS_SQL.format(where=where), params)
+            for patient_id, *recommendation in cursor:
+                recommendations.setdefault(patient_id, []).append(tuple(recommendation))
+
+            feedback = {}
+            cursor.execute(PATIENT_FEEDBACK_SQL.format(where=where), params)
+            for patient_id, *event in cursor:
+                feedback.setdefault(patient_id, []).append(tuple(event))
+
+            # Latest Big Five scores per patient
+            cursor.execute(LATEST_BIG5_SQL.format(where=where), params)
+            big5_scores = {row[0]: tuple(row[1:]) for row in cursor}
+
+            return [{
+                'patient_info': patient,
+                'sessions': sessions.get(patient[0], []),
+                'recommendations': recommendations.get(patient[0], []),
+                'feedback': feedback.get(patient[0], []),
+                'big5_scores': big5_scores.get(patient[0], (0, 0, 0, 0, 0, 0))
+            } for patient in patients]
+
+        except Exception as e:
+            st.error(f"Database error: {str(e)}")
+            return []
 
-        for patient in patients:
-            patient_id = patient[0]
+# Sort options of the patient list: key columns (unique as a whole) and direction.
+# The keyset cursor compares them as a row value, which relies on migration 2
+# making patients.created_at NOT NULL.
+PATIENT_SORTS = {
+    "Latest First": (["p.created_at", "p.patient_id"], "DESC"),
+    "Oldest First": (["p.created_at", "p.patient_id"], "ASC"),
+    "Most Sessions": (["COALESCE(s.session_count, 0)", "p.created_at", "p.patient_id"], "DESC"),
+    "Most Feedback": (["COALESCE(f.feedback_count, 0)", "p.created_at", "p.patient_id"], "DESC"),
+}
 
-            # Get therapy sessions and recommendations
-            cursor.execute('''
-                SELECT id, session_date, recommendations_count
-                FROM therapy_sessions WHERE patient_id = ?
-                ORDER BY session_date DESC
-            ''', (patient_id,))
-            sessions = cursor.fetchall()
+def get_patient_page(search_term: str = "", condition: Optional[str] = None, sort_by: str = "Latest First",
+                     page_size: int = 25, after: Optional[Tuple] = None, count: bool = True):
+    """Get one page of patient IDs with filtering, sorting and keyset pagination done in SQL.
 
-            # Get therapy recommendations with song details
-            cursor.execute('''
-                SELECT category, song_title, video_id, channel, rank
-                FROM therapy_recommendations WHERE patient_id = ?
-                ORDER BY category, rank
-            ''', (patient_id,))
-            recommendations = cursor.fetchall()
-
-            # Get feedback data
-            cursor.execute('''
-                SELECT feedback_type, reward, created_at
-                FROM therapy_feedback WHERE patient_id = ?
-                ORDER BY created_at DESC
-            ''', (patient_id,))
-            feedback = cursor.fetchall()
-
-            # Get Big Five scores if available
-            cursor.execute('''
-                SELECT openness, conscientiousness, extraversion,
-                       agreeableness, neuroticism, reinforcement_learning
-                FROM big5_scores WHERE patient_id = ?
-                ORDER BY created_at DESC LIMIT 1
-            ''', (patient_id,))
-            big5_scores = cursor.fetchone()
+    ``after`` is the cursor returned for the previous page. Returns
+    (patient_ids, next_cursor, total_matches); next_cursor is None on the last page.
+    Counting a name search reads every patient, so with ``count=False`` the
+    count is skipped; total_matches is None then and after a database error.
+    """
+    columns, direction = PATIENT_SORTS.get(sort_by, PATIENT_SORTS["Latest First"])
 
-            patient_data.append({
-                'patient_info': patient,
-                'sessions': sessions,
-                'recommendations': recommendations,
-                'feedback': feedback,
-                'big5_scores': big5_scores or (0, 0, 0, 0, 0, 0)
-            })
+    joins = ''
+    if sort_by == "Most Sessions":
+        joins = PATIENT_SESSION_COUNTS_JOIN
+    elif sort_by == "Most Feedback":
+        joins = PATIENT_FEEDBACK_COUNTS_JOIN
 
-        conn.close()
-        return patient_data
+    conditions, params = [], []
+    if search_term:
+        conditions.append(PATIENT_NAME_FILTER)
+        params.append(_like_contains(search_term.casefold()))
+    if condition:
+        conditions.append(PATIENT_CONDITION_FILTER)
+        params.append(_like_contains(condition))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+
+    key_list = ', '.join(columns)
+    order = ', '.join(f"{column} {direction}" for column in columns)
+    keyset = ''
+    page_params = list(params)
+    if after is not None:
+        keyset = f"{'AND' if where else 'WHERE'} ({key_list}) {'<' if direction == 'DESC' else '>'} " \
+                 f"({', '.join('?' * len(columns))})"
+        page_params.extend(after)
+
+    total = None
+    try:
+        with patient_db() as conn:
+            if count:
+                total = conn.execute(PATIENT_COUNT_SQL.format(where=where), params).fetchone()[0]
+            rows = conn.execute(PATIENT_PAGE_SQL.format(key_list=key_list, joins=joins, where=where,
+                                                        keyset=keyset, order=order),
+                                page_params + [page_size + 1]).fetchall()
+    except sqlite3.Error as e:
+        st.error(f"Database query error: {str(e)}")
+        return [], None, None
 
-    except Exception as e:
-        st.error(f"Database error: {str(e)}")
-        conn.close()
-        return []
+    next_cursor = tuple(rows[page_size - 1][1:]) if len(rows) > page_size else None
+    return [row[0] for row in rows[:page_size]], next_cursor, total
 
 def page_patient_database():
     """Advanced Patient Database Management Page"""
@@ -1105,23 +1136,21 @@ def page_patient_database():
 
     # Database connection status
     try:
-        conn = get_patient_db_connection()
-        cursor = conn.cursor()
+        with patient_db() as conn:
+            cursor = conn.cursor()
 
-        # Get database statistics
-        cursor.execute("SELECT COUNT(*) FROM patients")
-        total_patients = cursor.fetchone()[0]
+            # Get database statistics
+            cursor.execute("SELECT COUNT(*) FROM patients")
+            total_patients = cursor.fetchone()[0]
 
-        cursor.execute("SELECT COUNT(*) FROM therapy_sessions")
-        total_sessions = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM therapy_sessions")
+            total_sessions = cursor.fetchone()[0]
 
-        cursor.execute("SELECT COUNT(*) FROM therapy_recommendations")
-        total_recommendations = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM therapy_recommendations")
+            total_recommendations = cursor.fetchone()[0]
 
-        cursor.execute("SELECT COUNT(*) FROM therapy_feedback")
-        total_feedback = cursor.fetchone()[0]
-
-        conn.close()
+            cursor.execute("SELECT COUNT(*) FROM therapy_feedback")
+            total_feedback = cursor.fetchone()[0]
 
         # Display statistics
         col1, col2, col3, col4 = st.columns(4)
@@ -1181,47 +1210,61 @@ def page_patient_database():
         sort_by = st.selectbox(" Sort by",
                               ["Latest First", "Oldest First", "Most Sessions", "Most Feedback"])
 
-    # Get comprehensive patient data
-    patient_data = get_comprehensive_patient_data()
+    col1, col2 = st.columns([1, 3])
+    with col1:
+        page_size = st.selectbox(" Patients per page", [10, 25, 50, 100], index=1)
 
-    if not patient_data:
-        st.info("No patient records found in the database.")
-        return
+    condition_map = {
+        "Dementia / Alzheimer's": "dementia",
+        "Down Syndrome": "down_syndrome",
+        "ADHD": "adhd"
+    }
+    condition = condition_map.get(condition_filter)
 
-    # Apply filters
-    filtered_data = patient_data.copy()
+    # Cursors of the pages visited so far and the match count; reset whenever the filters change
+    filters = (search_term, condition, sort_by, page_size)
+    if st.session_state.get('patient_page_filters') != filters:
+        st.session_state.patient_page_filters = filters
+        st.session_state.patient_page_cursors = [None]
+        st.session_state.patient_page_total = None
+    cursors = st.session_state.patient_page_cursors
 
-    if search_term:
-        filtered_data = [p for p in filtered_data
-                        if search_term.lower() in p['patient_info'][1].lower()]
-
-    if condition_filter != "All Conditions":
-        condition_map = {
-            "Dementia / Alzheimer's": "dementia",
-            "Down Syndrome": "down_syndrome",
-            "ADHD": "adhd"
-        }
-        filtered_data = [p for p in filtered_data
-                        if condition_map.get(condition_filter, "") in str(p['patient_info'][3]).lower()]
-
-    # Apply sorting
-    if sort_by == "Latest First":
-        filtered_data.sort(key=lambda x: x['patient_info'][4] if len(x['patient_info']) > 4 else "", reverse=True)
-    elif sort_by == "Oldest First":
-        filtered_data.sort(key=lambda x: x['patient_info'][4] if len(x['patient_info']) > 4 else "")
-    elif sort_by == "Most Sessions":
-        filtered_data.sort(key=lambda x: len(x['sessions']), reverse=True)
-    elif sort_by == "Most Feedback":
-        filtered_data.sort(key=lambda x: len(x['feedback']), reverse=True)
+    patient_ids, next_cursor, total_matches = get_patient_page(
+        search_term, condition, sort_by, page_size, cursors[-1],
+        count=st.session_state.patient_page_total is None
+    )
+    if total_matches is None:
+        total_matches = st.session_state.patient_page_total or 0
+    else:
+        st.session_state.patient_page_total = total_matches
 
-    if not filtered_data:
-        st.warning("No patients match the selected filters.")
+    if total_matches == 0:
+        if search_term or condition:
+            st.warning("No patients match the selected filters.")
+        else:
+            st.info("No patient records found in the database.")
         return
 
-    st.success(f"Found {len(filtered_data)} patient(s) matching your criteria")
+    page_number = len(cursors)
+    page_count = max(1, -(-total_matches // page_size))
+    st.success(f"Found {total_matches} patient(s) matching your criteria")
+
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("◀ Previous", disabled=page_number == 1, use_container_width=True):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        st.markdown(f"<p style='text-align:center;'>Page {page_number} of {page_count}</p>", unsafe_allow_html=True)
+    with col3:
+        if st.button("Next ▶", disabled=next_cursor is None, use_container_width=True):
+            cursors.append(next_cursor)
+            st.rerun()
+
+    page_data = get_comprehensive_patient_data(patient_ids)
 
     # Enhanced patient display
-    for idx, patient in enumerate(filtered_data):
+    for idx, patient in enumerate(page_data):
         patient_info = patient['patient_info']
         sessions = patient['sessions']
         recommendations = patient['recommendations']
@@ -1384,6 +1427,8 @@ def page_patient_database():
                         delete_patient(patient_info[0])
                         st.success("Patient deleted successfully!")
                         st.session_state[confirm_key] = False
+                        # Recount the matches on the next render
+                        st.session_state.patient_page_total = None
                         st.rerun()
                 with col2:
                     no_key = f"confirm_no_{patient_info[0] if patient_info[0] is not None else 'unknown'}_{hash(str(patient_info))}"
@@ -1875,11 +1920,12 @@ def render_recommendations_with_feedback(recommendations: Dict, patient_info: Di
     </div>
     """, unsafe_allow_html=True)
     
-    # Get TheraMuse instance
-    if 'theramuse' not in st.session_state:
-        st.session_state.theramuse = TheraMuse(db_path=str(get_database_path()))
-
-    theramuse = st.session_state.theramuse
+    # Feedback is applied to the shared model by a background worker
+    feedback_queue = get_feedback_queue()
+    if feedback_queue.recent_failures:
+        last = feedback_queue.recent_failures[-1]
+        st.warning(f"{feedback_queue.failed + feedback_queue.rejected} feedback event(s) could not be recorded. "
+                   f"Latest: {last['feedback']} for patient {last['patient_id']} at {last['time']} ({last['error']})")
     
     # Display by category
     category_labels = {
@@ -1922,29 +1968,35 @@ def render_recommendations_with_feedback(recommendations: Dict, patient_info: Di
                     
                     # Feedback buttons
                     if st.button(" Like", key=f"like_{feedback_key}", width='stretch'):
-                        theramuse.record_feedback(
-                            patient_id, session_id, 
+                        if not feedback_queue.submit(
+                            patient_id, session_id,
                             get_condition_code(patient_info.get('condition', 'dementia')),
                             song, "like", patient_info
-                        )
-                        st.success(" Feedback recorded!")
-                        st.toast("Thank you for your feedback!")
+                        ):
+                            st.error("Feedback could not be recorded right now, please try again.")
+                        else:
+                            st.success(" Feedback received!")
+                            st.toast("Thank you for your feedback!")
                     
                     if st.button(" Dislike", key=f"dislike_{feedback_key}", width='stretch'):
-                        theramuse.record_feedback(
+                        if not feedback_queue.submit(
                             patient_id, session_id,
                             get_condition_code(patient_info.get('condition', 'dementia')),
                             song, "dislike", patient_info
-                        )
-                        st.info("Feedback recorded!")
+                        ):
+                            st.error("Feedback could not be recorded right now, please try again.")
+                        else:
+                            st.info("Feedback received!")
                     
                     if st.button(" Skip", key=f"skip_{feedback_key}", width='stretch'):
-                        theramuse.record_feedback(
+                        if not feedback_queue.submit(
                             patient_id, session_id,
                             get_condition_code(patient_info.get('condition', 'dementia')),
                             song, "skip", patient_info
-                        )
-                        st.info("Skipped!")
+                        ):
+                            st.error("Feedback could not be recorded right now, please try again.")
+                        else:
+                            st.info("Skipped!")
                     
                     st.markdown("</div>", unsafe_allow_html=True)
 
@@ -2262,10 +2314,7 @@ def page_intake():
             # Initialize TheraMuse
             with st.spinner(f" TheramuseRX is generating personalized recommendations "):
                 try:
-                    if 'theramuse' not in st.session_state:
-                        st.session_state.theramuse = TheraMuse(db_path=str(get_database_path()))
-
-                    theramuse = st.session_state.theramuse
+                    theramuse = get_shared_theramuse()
 
                     # Get recommendations
                     recommendations = theramuse.get_therapy_recommendations(
@@ -2412,11 +2461,19 @@ def page_analytics():
     </div>
     """, unsafe_allow_html=True)
     
-    if 'theramuse' not in st.session_state:
-        st.session_state.theramuse = TheraMuse(db_path=str(get_database_path()))
-
-    theramuse = st.session_state.theramuse
+    theramuse = get_shared_theramuse()
     analytics = theramuse.get_analytics()
+
+    # Feedback still waiting for, or rejected by, the background worker
+    feedback_queue = get_feedback_queue()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Feedback Pending", feedback_queue.pending())
+    col2.metric("Feedback Applied", feedback_queue.processed)
+    col3.metric("Feedback Failed", feedback_queue.failed)
+    col4.metric("Feedback Rejected", feedback_queue.rejected)
+    if feedback_queue.recent_failures:
+        st.warning("Some feedback could not be recorded:")
+        st.dataframe(pd.DataFrame(list(feedback_queue.recent_failures)), hide_index=True, use_container_width=True)
     
     # Top metrics
     col1, col2, col3 = st.columns(3)
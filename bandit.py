@@ -0,0 +1,432 @@
+"""Linear Thompson Sampling bandit for per-condition music recommendations.
+
+The persisted state (n_features, alpha, lambda_reg, B, mu, f, n_interactions,
+total_reward) has the same layout as the LinearThompsonSampling objects
+stored in theramuse_model.pkl, so existing bandits can be adopted with
+``LinearThompsonSampling.from_state(vars(old_bandit))``.
+
+Several server processes can train one model without a global lock: each
+worker calls ``take_delta()`` on its bandits at a fixed interval and writes
+the result with ``save_deltas()``; the process that owns the saved model
+folds the spool into it with ``merge_spooled_deltas()``, saves the model with
+the merged file names in its header and only then deletes those files with
+``remove_spool_files()``. A file named in the saved header is skipped by the
+next merge, so a crash between the save and the delete cannot count its
+events twice (``model_store.merge_spool()`` runs the whole sequence).
+The Streamlit app serves every session from one process and does not spool;
+taking and saving deltas is left to deployments that run several workers.
+"""
+
+import math
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy.linalg import solve_triangular
+
+# Sherman-Morrison and the Cholesky update accumulate rounding error slowly;
+# rebuild both caches from B after this many rank-1 updates.
+REFRESH_INTERVAL = 1024
+
+# The rank-1 Cholesky update is O(d^2) but runs a Python loop over d; below
+# this dimension a LAPACK refactorisation is faster, so the factor is only
+# marked stale on update and rebuilt the next time a sample is drawn.
+CHOLESKY_UPDATE_MIN_DIM = 512
+
+# With decay < 1 the posterior is stored as B = scale * B_tilde; once scale
+# falls below this the scale is folded back into B and f and the prior
+# restored, so the prior never drops below this fraction of lambda_reg * I.
+DECAY_RENORMALIZE_BELOW = 0.1
+
+
+def cholesky_rank1_update(L: np.ndarray, x: np.ndarray) -> None:
+    """In-place update of lower-triangular L so that L L^T becomes L L^T + x x^T (O(d^2))"""
+    x = np.array(x, dtype=float)
+    n = x.shape[0]
+    for k in range(n):
+        l_kk = L[k, k]
+        r = math.hypot(l_kk, x[k])
+        c = r / l_kk
+        s = x[k] / l_kk
+        L[k, k] = r
+        if k + 1 < n:
+            L[k + 1:, k] = (L[k + 1:, k] + s * x[k + 1:]) / c
+            x[k + 1:] = c * x[k + 1:] - s * L[k + 1:, k]
+
+
+class SufficientStatsDelta:
+    """Additive feedback statistics (dB = sum x x^T, df = sum r x) not yet merged.
+
+    Linear Thompson Sampling state is a sum over feedback events, so deltas
+    from several worker processes can be merged into a central model in any
+    order without coordinating the workers.
+    """
+
+    def __init__(self, n_features: int):
+        self.n_features = n_features
+        self.dB = np.zeros((n_features, n_features))
+        self.df = np.zeros(n_features)
+        self.n_interactions = 0
+        self.total_reward = 0.0
+
+    def __bool__(self) -> bool:
+        return self.n_interactions > 0
+
+    def add(self, context: np.ndarray, reward: float):
+        """Record one (context, reward) observation"""
+        x = np.asarray(context, dtype=float).ravel()
+        self.dB += np.outer(x, x)
+        self.df += reward * x
+        self.n_interactions += 1
+        self.total_reward += float(reward)
+
+    def combine(self, other: "SufficientStatsDelta"):
+        """Fold another delta into this one"""
+        if other.n_features != self.n_features:
+            raise ValueError(f"Delta has {other.n_features} features, expected {self.n_features}")
+        self.dB += other.dB
+        self.df += other.df
+        self.n_interactions += other.n_interactions
+        self.total_reward += other.total_reward
+
+    def to_state(self) -> Dict:
+        return {
+            'n_features': self.n_features,
+            'dB': self.dB,
+            'df': self.df,
+            'n_interactions': self.n_interactions,
+            'total_reward': self.total_reward,
+        }
+
+    @classmethod
+    def from_state(cls, state: Dict) -> "SufficientStatsDelta":
+        delta = cls(int(state['n_features']))
+        delta.dB = np.array(state['dB'], dtype=float)
+        delta.df = np.array(state['df'], dtype=float)
+        delta.n_interactions = int(state['n_interactions'])
+        delta.total_reward = float(state['total_reward'])
+        return delta
+
+
+def save_deltas(deltas: Dict[str, SufficientStatsDelta], spool_dir: str) -> Optional[Path]:
+    """Atomically write one worker's per-condition deltas into a spool directory.
+
+    Each call writes a new uniquely named file (temp file + rename), so any
+    number of workers can spool concurrently without a shared lock.
+    """
+    arrays = {}
+    for condition, delta in deltas.items():
+        if not delta:
+            continue
+        arrays[f"{condition}/dB"] = delta.dB
+        arrays[f"{condition}/df"] = delta.df
+        arrays[f"{condition}/meta"] = np.array([delta.n_features, delta.n_interactions, delta.total_reward])
+    if not arrays:
+        return None
+
+    spool = Path(spool_dir)
+    spool.mkdir(parents=True, exist_ok=True)
+    path = spool / f"delta_{os.getpid()}_{time.time_ns()}.npz"
+    fd, tmp_path = tempfile.mkstemp(dir=spool, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            np.savez(fh, **arrays)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def load_deltas(path: str) -> Dict[str, SufficientStatsDelta]:
+    """Read a spool file written by save_deltas"""
+    deltas = {}
+    with np.load(path, allow_pickle=False) as data:
+        conditions = {key.split('/', 1)[0] for key in data.files}
+        for condition in conditions:
+            n_features, n_interactions, total_reward = data[f"{condition}/meta"]
+            deltas[condition] = SufficientStatsDelta.from_state({
+                'n_features': n_features,
+                'dB': data[f"{condition}/dB"],
+                'df': data[f"{condition}/df"],
+                'n_interactions': n_interactions,
+                'total_reward': total_reward,
+            })
+    return deltas
+
+
+def merge_spooled_deltas(bandits: Dict[str, "LinearThompsonSampling"], spool_dir: str,
+                         already_merged: Iterable[str] = ()) -> Tuple[int, List[Path], List[str]]:
+    """Merge every complete spool file into bandits in memory.
+
+    Files whose names are in ``already_merged`` (the names recorded in the
+    saved model) are not merged again. A condition with no bandit yet gets a
+    new one with default parameters. Returns (events merged, paths of every
+    spool file now contained in bandits, conditions whose bandit was
+    created), skipped files included in the paths. The files
+    are left in place: record their names in the saved model and pass the
+    paths to remove_spool_files() only after that save, so a crash in between
+    neither loses nor double counts those events.
+    """
+    spool = Path(spool_dir)
+    if not spool.exists():
+        return 0, [], []
+
+    skip = set(already_merged)
+    merged = 0
+    created = []
+    paths = sorted(spool.glob("delta_*.npz"))
+    for path in paths:
+        if path.name in skip:
+            continue
+        for condition, delta in load_deltas(str(path)).items():
+            if not delta:
+                continue
+            if condition not in bandits:
+                # The file is reported as merged, so its events must not be dropped
+                bandits[condition] = LinearThompsonSampling(delta.n_features)
+                created.append(condition)
+            bandits[condition].merge_delta(delta)
+            merged += delta.n_interactions
+    return merged, paths, created
+
+
+def remove_spool_files(paths: List[Path]):
+    """Delete spool files whose deltas are now part of a saved model"""
+    for path in paths:
+        try:
+            Path(path).unlink()
+        except FileNotFoundError:
+            pass
+
+
+class _Posterior:
+    """Immutable snapshot of what sampling and scoring read from a bandit.
+
+    ``update`` builds a new snapshot and swaps it in with one attribute
+    assignment, so readers in other threads always see a consistent mu, B^-1
+    and Cholesky factor without taking a lock. The factor is computed lazily
+    from B when the writer did not maintain one; two readers racing to build
+    it compute the same matrix.
+    """
+
+    __slots__ = ('mu', 'B', 'B_inv', 'scale', 'L')
+
+    def __init__(self, mu: np.ndarray, B: np.ndarray, B_inv: np.ndarray, scale: float,
+                 L: Optional[np.ndarray] = None):
+        self.mu = mu
+        self.B = B
+        self.B_inv = B_inv
+        self.scale = scale
+        self.L = L
+
+    def factor(self) -> np.ndarray:
+        if self.L is None:
+            self.L = np.linalg.cholesky(self.B)
+        return self.L
+
+
+class LinearThompsonSampling:
+    """Linear Thompson Sampling with O(d^2) rank-1 posterior maintenance.
+
+    Alongside B we keep B^-1 (updated with Sherman-Morrison) and a cached
+    lower Cholesky factor L of B, so ``update`` never solves a d x d system and
+    ``sample_theta`` only needs a triangular solve. L is maintained with a
+    rank-1 update for large d and refactorised at most once per sample (after
+    a burst of updates) for small d, where that is cheaper.
+
+    Updates must be serialised by the caller, but sampling and scoring may
+    run concurrently with an update: they read an immutable snapshot of the
+    posterior that every update replaces (copy-on-write, O(d^2) per update).
+
+    With ``decay`` < 1 old evidence is discounted exponentially
+    (E <- decay * E + x x^T, f <- decay * f + r x) so the model follows
+    patients whose tastes shift, while B = lambda_reg * I + E keeps its prior.
+    The discount is applied lazily through a global scale factor: B and f
+    hold B / scale and f / scale, mu is unaffected and the covariance is
+    B^-1 / scale, so each update stays O(d^2). Between folds the prior decays
+    along with the evidence; when the scale drops below
+    DECAY_RENORMALIZE_BELOW it is folded back into B and f and the prior is
+    topped back up to lambda_reg * I. The prior therefore stays between
+    DECAY_RENORMALIZE_BELOW * lambda_reg and lambda_reg, and B stays positive
+    definite even for contexts that never span every direction.
+    """
+
+    def __init__(self, n_features: int = 20, alpha: float = 1.0, lambda_reg: float = 1.0,
+                 seed: Optional[int] = None, decay: float = 1.0):
+        if not 0.0 < decay <= 1.0:
+            raise ValueError(f"decay must be in (0, 1], got {decay}")
+        self.n_features = n_features
+        self.alpha = alpha
+        self.lambda_reg = lambda_reg
+        self.decay = decay
+        self._scale = 1.0
+        self.B = lambda_reg * np.eye(n_features)
+        self.mu = np.zeros(n_features)
+        self.f = np.zeros(n_features)
+        self.n_interactions = 0
+        self.total_reward = 0.0
+        self._rng = np.random.default_rng(seed)
+        self._delta = SufficientStatsDelta(n_features)
+        self._refresh_caches()
+
+    @classmethod
+    def from_state(cls, state: Dict, seed: Optional[int] = None) -> "LinearThompsonSampling":
+        """Build a bandit from a saved attribute dict (e.g. a pickled bandit's __dict__)"""
+        bandit = cls.__new__(cls)
+        bandit.__setstate__(dict(state))
+        if seed is not None:
+            bandit._rng = np.random.default_rng(seed)
+        return bandit
+
+    def __getstate__(self) -> Dict:
+        # Keep pickles in the original layout (plus decay); caches are rebuilt on load
+        return {
+            'n_features': self.n_features,
+            'alpha': self.alpha,
+            'lambda_reg': self.lambda_reg,
+            'decay': self.decay,
+            'B': self.B * self._scale,
+            'mu': self.mu,
+            'f': self.f * self._scale,
+            'n_interactions': self.n_interactions,
+            'total_reward': self.total_reward,
+        }
+
+    def __setstate__(self, state: Dict):
+        self.n_features = int(state.get('n_features', len(state['f'])))
+        self.alpha = float(state.get('alpha', 1.0))
+        self.lambda_reg = float(state.get('lambda_reg', 1.0))
+        self.decay = float(state.get('decay', 1.0))
+        self._scale = 1.0
+        self.B = np.array(state['B'], dtype=float)
+        self.f = np.array(state['f'], dtype=float)
+        self.n_interactions = int(state.get('n_interactions', 0))
+        self.total_reward = float(state.get('total_reward', 0.0))
+        self._rng = np.random.default_rng()
+        self._delta = SufficientStatsDelta(self.n_features)
+        self._refresh_caches()
+
+    def _refresh_caches(self):
+        """Recompute B^-1, the Cholesky factor and mu exactly from B and f (O(d^3))"""
+        self._L = np.linalg.cholesky(self.B)
+        self._chol_stale = False
+        L_inv = solve_triangular(self._L, np.eye(self.n_features), lower=True)
+        self._B_inv = L_inv.T @ L_inv
+        self.mu = self._B_inv @ self.f
+        self._updates_since_refresh = 0
+        self._publish()
+
+    def _publish(self):
+        """Swap in a snapshot of the current posterior for readers"""
+        L = None if self._chol_stale else self._L.copy()
+        self._posterior = _Posterior(self.mu.copy(), self.B.copy(), self._B_inv.copy(), self._scale, L)
+
+    def _renormalize(self):
+        """Fold the lazy decay scale into B and f and restore the prior to lambda_reg * I"""
+        if self._scale == 1.0:
+            return
+        self.B *= self._scale
+        # Only evidence is discounted; the prior lambda_reg * I in B decayed with it
+        self.B[np.diag_indices(self.n_features)] += self.lambda_reg * (1.0 - self._scale)
+        self.f *= self._scale
+        self._scale = 1.0
+        self._refresh_caches()
+
+    def update(self, context: np.ndarray, reward: float):
+        """Add one (context, reward) observation to the posterior in O(d^2)"""
+        x = np.asarray(context, dtype=float).ravel()
+        self.n_interactions += 1
+        self.total_reward += float(reward)
+        self._delta.add(x, reward)
+
+        if self.decay < 1.0:
+            # Discount everything seen so far by shrinking the global scale
+            # instead of multiplying B and f
+            self._scale *= self.decay
+        weight = 1.0 / self._scale
+        x_scaled = x * math.sqrt(weight) if weight != 1.0 else x
+
+        B_inv_x = self._B_inv @ x_scaled
+        denom = 1.0 + x_scaled @ B_inv_x
+        self._B_inv -= np.outer(B_inv_x, B_inv_x) / denom
+        self.B += np.outer(x_scaled, x_scaled)
+        self.f += reward * weight * x
+        if self.n_features >= CHOLESKY_UPDATE_MIN_DIM and not self._chol_stale:
+            cholesky_rank1_update(self._L, x_scaled)
+        else:
+            self._chol_stale = True
+        self.mu = self._B_inv @ self.f
+
+        self._updates_since_refresh += 1
+        if self._scale < DECAY_RENORMALIZE_BELOW:
+            self._renormalize()
+        elif self._updates_since_refresh >= REFRESH_INTERVAL:
+            self._refresh_caches()
+        else:
+            self._publish()
+
+    def take_delta(self) -> SufficientStatsDelta:
+        """Return the statistics added by ``update`` since the last call and start a new delta"""
+        delta, self._delta = self._delta, SufficientStatsDelta(self.n_features)
+        return delta
+
+    def merge_delta(self, delta: SufficientStatsDelta):
+        """Fold statistics collected elsewhere into this model.
+
+        Merged evidence is not added to this model's own pending delta, so a
+        worker can merge its peers' deltas without re-broadcasting them.
+        """
+        if not delta:
+            return
+        if delta.n_features != self.n_features:
+            raise ValueError(f"Delta has {delta.n_features} features, expected {self.n_features}")
+        self._renormalize()
+        self.B += delta.dB
+        self.f += delta.df
+        self.n_interactions += delta.n_interactions
+        self.total_reward += delta.total_reward
+        self._refresh_caches()
+
+    def sample_theta(self) -> np.ndarray:
+        """Draw theta ~ N(mu, alpha^2 B^-1) using the cached Cholesky factor"""
+        posterior = self._posterior
+        z = self._rng.standard_normal(self.n_features)
+        # L^-T z has covariance (L L^T)^-1 = B^-1; the decay scale divides it
+        scale = self.alpha / math.sqrt(posterior.scale)
+        return posterior.mu + scale * solve_triangular(posterior.factor(), z, lower=True, trans='T')
+
+    def predict(self, context: np.ndarray) -> float:
+        """Score a single context vector against one posterior sample"""
+        return float(np.asarray(context, dtype=float).ravel() @ self.sample_theta())
+
+    def confidence_width(self, context: np.ndarray) -> float:
+        """Posterior standard deviation of the mean reward, sqrt(x^T B^-1 x)"""
+        x = np.asarray(context, dtype=float).ravel()
+        posterior = self._posterior
+        return float(math.sqrt(max(x @ posterior.B_inv @ x, 0.0) / posterior.scale))
+
+    def score_candidates(self, contexts: np.ndarray, top_k: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Score an (n_candidates x n_features) matrix against one posterior sample.
+
+        Returns (scores, top_indices) where top_indices holds the best ``top_k``
+        rows ordered by descending score (all rows when top_k is None).
+        """
+        X = np.asarray(contexts, dtype=float)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        scores = X @ self.sample_theta()
+
+        n = scores.shape[0]
+        if top_k is None or top_k >= n:
+            top = np.argsort(-scores)
+        elif top_k <= 0:
+            top = np.empty(0, dtype=np.intp)
+        else:
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            top = top[np.argsort(-scores[top])]
+        return scores, top
@@ -0,0 +1,162 @@
+"""Prefetch the most common YouTube queries into the search cache.
+
+Queries are highly predictable: they combine a nostalgia window, a place,
+genres, seasons and natural elements. This job ranks the queries found in
+therapy_sessions.session_data by how often they were issued, optionally
+expands each query template to every nostalgia window seen in the history,
+and fetches the top N that are not already cached, at a bounded rate.
+
+Run it from cron during off-hours, e.g.::
+
+    python cache_warmup.py --top 500 --rate 0.5 --only-between 01:00-06:00
+"""
+
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from search_query import canonical_query
+from youtube_search import DEFAULT_MAX_RESULTS, YouTubeSearchClient
+
+WINDOW_PATTERN = re.compile(r'\b(\d{4}-\d{4})\b')
+WINDOW_PLACEHOLDER = '{window}'
+
+
+def iter_session_queries(db_path: str) -> Iterator[Tuple[str, str]]:
+    """Yield (category, canonical query) for every query in therapy_sessions.session_data"""
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.execute('SELECT session_data FROM therapy_sessions WHERE session_data IS NOT NULL')
+        for (session_data,) in cursor:
+            try:
+                categories = json.loads(session_data).get('categories', {})
+            except (TypeError, ValueError, AttributeError):
+                continue
+            for category, data in categories.items():
+                if not isinstance(data, dict):
+                    continue
+                queries = data.get('query')
+                for query in queries if isinstance(queries, list) else [queries]:
+                    if isinstance(query, str) and query.strip():
+                        yield category, canonical_query(query, category)
+    finally:
+        conn.close()
+
+
+def query_categories(history: List[Tuple[str, str]]) -> Dict[str, str]:
+    """Most common category of each query, so it is cached with that category's TTL"""
+    counts = Counter(history)
+    categories: Dict[str, str] = {}
+    for (category, query), _ in counts.most_common():
+        categories.setdefault(query, category)
+    return categories
+
+
+def rank_queries(queries: List[str], expand_windows: bool = False) -> List[Tuple[str, float]]:
+    """Rank queries by historical frequency.
+
+    With expand_windows, each query containing a nostalgia window also
+    contributes its template filled with every other observed window, scored
+    by template frequency x window share, so patients from birth decades not
+    seen yet are covered too.
+    """
+    scores = Counter(queries)
+    if expand_windows:
+        windows = Counter(m.group(1) for q in queries for m in [WINDOW_PATTERN.search(q)] if m)
+        total_windows = sum(windows.values())
+        templates = Counter(WINDOW_PATTERN.sub(WINDOW_PLACEHOLDER, q, count=1)
+                            for q in queries if WINDOW_PATTERN.search(q))
+        for template, template_count in templates.items():
+            for window, window_count in windows.items():
+                query = template.replace(WINDOW_PLACEHOLDER, window)
+                expanded = template_count * window_count / total_windows
+                if expanded > scores.get(query, 0):
+                    scores[query] = expanded
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+def within_window(spec: Optional[str], now: Optional[datetime] = None) -> bool:
+    """Whether now falls inside an HH:MM-HH:MM window (which may wrap midnight)"""
+    if not spec:
+        return True
+    start_text, end_text = spec.split('-')
+    now = (now or datetime.now()).time()
+    start = datetime.strptime(start_text, '%H:%M').time()
+    end = datetime.strptime(end_text, '%H:%M').time()
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+
+def warm_cache(client: YouTubeSearchClient, ranked: List[Tuple[str, float]], top: int,
+               rate: float, only_between: Optional[str] = None,
+               categories: Optional[Dict[str, str]] = None) -> dict:
+    """Fetch the top queries without a fresh cache entry, at no more than ``rate`` requests per second"""
+    interval = 1.0 / rate if rate > 0 else 0.0
+    fetched = skipped = failed = 0
+    next_request = time.monotonic()
+
+    for query, _ in ranked[:top]:
+        if not within_window(only_between):
+            print("Outside the allowed time window, stopping")
+            break
+        if client.cache.contains(query, DEFAULT_MAX_RESULTS):
+            skipped += 1
+            continue
+
+        delay = next_request - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        next_request = time.monotonic() + interval
+
+        try:
+            client.prefetch(query, DEFAULT_MAX_RESULTS, (categories or {}).get(query))
+            fetched += 1
+        except Exception as e:
+            failed += 1
+            print(f"Failed to prefetch '{query}': {str(e)}")
+
+    return {'fetched': fetched, 'already_cached': skipped, 'failed': failed}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Prefetch common YouTube queries into the search cache")
+    parser.add_argument('--db', default="theramuse.db", help="Database with therapy_sessions history")
+    parser.add_argument('--top', type=int, default=200, help="Number of top-ranked queries to warm")
+    parser.add_argument('--rate', type=float, default=1.0, help="Maximum upstream requests per second")
+    parser.add_argument('--expand-windows', action='store_true',
+                        help="Also warm every query template for every observed nostalgia window")
+    parser.add_argument('--only-between', help="Only run inside this local time window, e.g. 01:00-06:00")
+    parser.add_argument('--dry-run', action='store_true', help="Print the ranked queries without fetching")
+    args = parser.parse_args(argv)
+
+    if not within_window(args.only_between):
+        print(f"Current time is outside {args.only_between}, nothing to do")
+        return 0
+
+    history = list(iter_session_queries(args.db))
+    categories = query_categories(history)
+    ranked = rank_queries([query for _, query in history], args.expand_windows)
+    if args.dry_run:
+        for query, score in ranked[:args.top]:
+            print(f"{score:8.2f}  {query}")
+        return 0
+
+    client = YouTubeSearchClient(db_path=args.db)
+    try:
+        summary = warm_cache(client, ranked, args.top, args.rate, args.only_between, categories)
+    finally:
+        client.close()
+    print(f"Warm-up done: {summary['fetched']} fetched, {summary['already_cached']} already cached, "
+          f"{summary['failed']} failed")
+    return 1 if summary['failed'] and not summary['fetched'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
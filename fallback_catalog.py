@@ -0,0 +1,139 @@
+"""Offline catalog of previously recommended songs.
+
+Used by the YouTube search client when the search proxy is unavailable. The
+catalog is built from the songs stored in therapy_sessions.session_data and
+therapy_recommendations, indexed by the words of the query that found them
+and of their title, and searched by word overlap with the new query.
+Every result carries ``'source': 'fallback'`` so callers can tell it from
+a live search result.
+
+The catalog is read once, on first use or ahead of it with ``preload()``;
+the database is opened read-only and never created.
+"""
+
+import json
+import re
+import sqlite3
+import threading
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from search_query import canonical_query
+
+# Words that appear in nearly every query and carry no signal
+STOPWORDS = frozenset({'song', 'songs', 'music', 'the', 'a', 'of', 'and', 'for', 'in'})
+QUERY_WEIGHT = 2.0
+TITLE_WEIGHT = 1.0
+
+_VIDEO_ID_PATTERN = re.compile(r'(?:v=|youtu\.be/|embed/|shorts/)([A-Za-z0-9_-]{11})')
+
+
+def _tokens(text: Optional[str]) -> Set[str]:
+    return {word for word in re.findall(r'[\w&-]+', canonical_query(text or '')) if word not in STOPWORDS}
+
+
+def _video_id(url: Optional[str]) -> Optional[str]:
+    match = _VIDEO_ID_PATTERN.search(url or '')
+    return match.group(1) if match else None
+
+
+class FallbackCatalog:
+    """Word-overlap search over songs already recommended in the database"""
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        # Held for the whole first load, so concurrent first searches build it once
+        self._load_lock = threading.Lock()
+        self._songs: List[Dict] = []
+        self._index: Dict[str, List[tuple]] = {}
+        self._loaded = False
+
+    def preload(self) -> threading.Thread:
+        """Build the catalog in a background thread so the first search does not have to"""
+        thread = threading.Thread(target=self._ensure_loaded, name="fallback-catalog", daemon=True)
+        thread.start()
+        return thread
+
+    def _ensure_loaded(self):
+        with self._load_lock:
+            if not self._loaded:
+                self.reload()
+
+    def reload(self) -> int:
+        """Rebuild the catalog from the database; returns the number of songs"""
+        songs: Dict[str, Dict] = {}
+        index: Dict[str, List[tuple]] = defaultdict(list)
+        positions: Dict[str, int] = {}
+
+        def add(query, title, url, video_id=None, channel=None):
+            video_id = video_id or _video_id(url)
+            key = video_id or url
+            if not key or not title:
+                return
+            if key not in songs:
+                positions[key] = len(songs)
+                songs[key] = {
+                    'title': title,
+                    'url': url or f"https://www.youtube.com/watch?v={video_id}",
+                    'video_id': video_id,
+                    'channel': channel,
+                    'source': 'fallback',
+                }
+            position = positions[key]
+            for word in _tokens(query):
+                index[word].append((position, QUERY_WEIGHT))
+            for word in _tokens(title):
+                index[word].append((position, TITLE_WEIGHT))
+
+        conn = None
+        try:
+            # Read-only so a missing database is reported instead of created empty
+            conn = sqlite3.connect(f"{Path(self.db_path).resolve().as_uri()}?mode=ro", uri=True)
+            for (session_data,) in conn.execute(
+                    'SELECT session_data FROM therapy_sessions WHERE session_data IS NOT NULL'):
+                try:
+                    categories = json.loads(session_data).get('categories', {})
+                except (TypeError, ValueError, AttributeError):
+                    continue
+                for data in categories.values():
+                    if not isinstance(data, dict):
+                        continue
+                    queries = data.get('query')
+                    query = ' '.join(queries) if isinstance(queries, list) else queries
+                    for song in data.get('songs') or []:
+                        if isinstance(song, dict):
+                            add(query, song.get('title'), song.get('url'))
+            try:
+                for query, title, video_id, channel in conn.execute(
+                        'SELECT query, song_title, video_id, channel FROM therapy_recommendations'):
+                    add(query, title, None, video_id, channel)
+            except sqlite3.OperationalError:
+                pass
+        except sqlite3.Error as e:
+            print(f"Could not build fallback catalog from {self.db_path}: {str(e)}")
+        finally:
+            if conn is not None:
+                conn.close()
+
+        with self._lock:
+            self._songs = list(songs.values())
+            self._index = dict(index)
+            self._loaded = True
+        return len(self._songs)
+
+    def search(self, query: str, max_results: int = 5) -> List[Dict]:
+        """Best matching catalog songs for query, by weighted word overlap"""
+        self._ensure_loaded()
+        with self._lock:
+            scores: Dict[int, float] = defaultdict(float)
+            for word in _tokens(query):
+                for position, weight in self._index.get(word, ()):
+                    scores[position] += weight
+            best = sorted(scores, key=lambda position: (-scores[position], position))[:max_results]
+            return [dict(self._songs[position]) for position in best]
+
+    def __len__(self) -> int:
+        self._ensure_loaded()
+        return len(self._songs)
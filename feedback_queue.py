@@ -0,0 +1,117 @@
+"""Bounded in-process queue of feedback events drained by a background worker.
+
+Feedback buttons only enqueue; the worker pulls up to ``batch_size`` events
+at a time and hands them to the model's ``record_feedback_batch`` together,
+so the Streamlit rerun never waits on the database write or model update.
+The queue holds at most ``maxsize`` events. When it is full, ``submit``
+rejects the event instead of buffering it: the caller is told, and the
+event is kept in ``recent_failures`` so the UI can show what was lost.
+"""
+
+import atexit
+import queue
+import threading
+from collections import deque
+from datetime import datetime
+from typing import List, Tuple
+
+QUEUE_FULL_ERROR = "feedback queue is full"
+
+
+class FeedbackQueue:
+    """Bounded feedback queue with one background worker.
+
+    ``close()`` (also registered with atexit) applies everything accepted
+    before it; ``submit`` and ``close`` share a lock, so an event is either
+    accepted ahead of the stop marker or, once closed, applied inline.
+    Failed and rejected events are kept in ``recent_failures`` for the UI.
+    """
+
+    _STOP = object()
+
+    def __init__(self, model, maxsize: int = 1000, batch_size: int = 32):
+        self._model = model
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._batch_size = batch_size
+        self._closed = False
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.recent_failures = deque(maxlen=20)
+        self._worker = threading.Thread(target=self._run, name="theramuse-feedback", daemon=True)
+        self._worker.start()
+        atexit.register(self.close)
+
+    def submit(self, patient_id: str, session_id: str, condition: str, song: dict,
+               feedback_type: str, patient_info: dict) -> bool:
+        """Queue one feedback event; returns False if the queue was full and the event was rejected.
+
+        After close() the event is recorded inline instead.
+        """
+        event = (patient_id, session_id, condition, song, feedback_type, patient_info)
+        with self._lock:
+            if not self._closed:
+                try:
+                    self._queue.put_nowait(event)
+                    return True
+                except queue.Full:
+                    self.rejected += 1
+                    self._record_failure(event, QUEUE_FULL_ERROR)
+                    return False
+        # The worker has stopped; record the event rather than drop clinician feedback
+        self._apply([event])
+        return True
+
+    def pending(self) -> int:
+        """Number of feedback events waiting to be applied"""
+        return self._queue.qsize()
+
+    def close(self, timeout: float = 30.0):
+        """Stop accepting events and wait until everything queued has been applied"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                # The worker frees a slot as it drains; it never takes _lock
+                self._queue.put(self._STOP, timeout=timeout)
+            except queue.Full:
+                print(f"Feedback queue still had {self.pending()} event(s) after {timeout:.0f}s at shutdown")
+                return
+        self._worker.join(timeout)
+        if self._worker.is_alive():
+            print(f"Feedback queue still had {self.pending()} event(s) after {timeout:.0f}s at shutdown")
+
+    def _record_failure(self, event: Tuple, error: str):
+        self.recent_failures.append({
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'patient_id': event[0],
+            'feedback': event[4],
+            'song': (event[3] or {}).get('title', '') if isinstance(event[3], dict) else '',
+            'error': error,
+        })
+
+    def _apply(self, batch: List[Tuple]):
+        failures = self._model.record_feedback_batch(batch)
+        self.processed += len(batch) - len(failures)
+        self.failed += len(failures)
+        for event, error in failures:
+            self._record_failure(event, error)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            events = [event for event in batch if event is not self._STOP]
+            stopping = len(events) != len(batch)
+            try:
+                if events:
+                    self._apply(events)
+            except Exception as e:
+                print(f"Failed to apply feedback batch: {str(e)}")
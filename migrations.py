@@ -0,0 +1,400 @@
+"""Versioned schema migrations for the TheraMuse database.
+
+The schema version is stored in ``PRAGMA user_version``. ``migrate`` applies
+every migration newer than that version, each in its own IMMEDIATE
+transaction, and bumps the version as part of the same transaction, so a
+migration is applied exactly once even with several app processes starting
+at the same time.
+
+The canonical schema keys patients by ``patient_id`` and gives every
+patient a ``created_at``. Databases created by older app versions, whose
+patients table used ``id`` or left registration dates empty, are rebuilt
+into it, and tables whose foreign keys still name the old key columns are
+rebuilt to reference the canonical ones.
+
+``check_query_plans`` runs EXPLAIN QUERY PLAN over the hot queries and
+reports any that would fall back to a full table scan or a temp B-tree sort.
+
+Usage: ``python migrations.py --db theramuse.db [--check-plans]``
+"""
+
+import argparse
+import sqlite3
+import sys
+from typing import Callable, Dict, List, Tuple
+
+# Canonical patients columns, in table order, after the patient_id key
+PATIENT_COLUMNS: List[Tuple[str, str]] = [
+    ('name', 'TEXT'),
+    ('age', 'INTEGER'),
+    ('birth_year', 'INTEGER'),
+    ('sex', 'TEXT'),
+    ('birthplace_city', 'TEXT'),
+    ('birthplace_country', 'TEXT'),
+    ('favorite_genre', 'TEXT'),
+    ('favorite_musician', 'TEXT'),
+    ('favorite_season', 'TEXT'),
+    ('instruments', 'TEXT'),
+    ('natural_elements', 'TEXT'),
+    ('condition', 'TEXT'),
+    ('difficulty_sleeping', 'BOOLEAN'),
+    ('trouble_remembering', 'BOOLEAN'),
+    ('forgets_everyday_things', 'BOOLEAN'),
+    ('difficulty_recalling_old_memories', 'BOOLEAN'),
+    ('memory_worse_than_year_ago', 'BOOLEAN'),
+    ('visited_mental_health_professional', 'BOOLEAN'),
+    ('extraversion', 'REAL'),
+    ('agreeableness', 'REAL'),
+    ('conscientiousness', 'REAL'),
+    ('neuroticism', 'REAL'),
+    ('openness', 'REAL'),
+    ('patient_info', 'TEXT'),
+    ('created_at', 'TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP'),
+    ('updated_at', 'TIMESTAMP'),
+]
+
+
+def _patients_ddl(table: str = 'patients') -> str:
+    columns = ',\n    '.join(f"{name} {kind}" for name, kind in PATIENT_COLUMNS)
+    return f"CREATE TABLE IF NOT EXISTS {table} (\n    patient_id TEXT PRIMARY KEY,\n    {columns}\n)"
+
+
+def _columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+
+
+# Canonical DDL of the tables keyed off patients, by table name; {table} is
+# the name to create, so a table can be rebuilt under a temporary name
+TABLES: Dict[str, str] = {
+    'therapy_sessions': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id TEXT PRIMARY KEY,
+            patient_id TEXT,
+            session_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            recommendations_count INTEGER,
+            session_data TEXT,
+            FOREIGN KEY (patient_id) REFERENCES patients (patient_id)
+        )
+    ''',
+    'sessions': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            session_id TEXT PRIMARY KEY,
+            patient_id TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            condition TEXT,
+            FOREIGN KEY (patient_id) REFERENCES patients (patient_id)
+        )
+    ''',
+    'big5_scores': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id TEXT,
+            session_id TEXT,
+            openness REAL,
+            conscientiousness REAL,
+            extraversion REAL,
+            agreeableness REAL,
+            neuroticism REAL,
+            reinforcement_learning INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+    'therapy_recommendations': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT NOT NULL,
+            patient_id TEXT NOT NULL,
+            category TEXT NOT NULL,
+            query TEXT,
+            song_title TEXT,
+            video_id TEXT,
+            channel TEXT,
+            description TEXT,
+            rank INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES therapy_sessions (id)
+        )
+    ''',
+    'therapy_feedback': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id TEXT NOT NULL,
+            session_id TEXT,
+            condition TEXT NOT NULL,
+            song_title TEXT,
+            video_id TEXT,
+            reward REAL NOT NULL,
+            feedback_type TEXT,
+            context_features TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''',
+}
+
+# (parent table, column) foreign key targets written by older app versions
+STALE_FOREIGN_KEYS = {('patients', 'id'), ('therapy_sessions', 'session_id')}
+
+
+def _create_tables(conn: sqlite3.Connection):
+    """Create every table the app and the recommendation engine read"""
+    conn.execute(_patients_ddl())
+    for table, ddl in TABLES.items():
+        conn.execute(ddl.format(table=table))
+
+
+def _canonical_patients(conn: sqlite3.Connection):
+    """Key patients by patient_id, give it every canonical column and point foreign keys at it"""
+    existing = _columns(conn, 'patients')
+    key = 'patient_id' if 'patient_id' in existing or 'id' not in existing else 'id'
+
+    # Rebuild rather than ALTER TABLE: the key may be the legacy id, and
+    # created_at must be NOT NULL for the keyset pagination of the patient list.
+    # Missing registration dates fall back to the first session, then to now.
+    conn.execute(_patients_ddl('patients_canonical'))
+    shared = [name for name, _ in PATIENT_COLUMNS if name in existing and name != 'created_at']
+    first_session = f"(SELECT MIN(s.session_date) FROM therapy_sessions s WHERE s.patient_id = p.{key})"
+    created_at = f"COALESCE({'p.created_at, ' if 'created_at' in existing else ''}{first_session}, CURRENT_TIMESTAMP)"
+    columns = ', '.join(['patient_id', *shared, 'created_at'])
+    values = ', '.join([f'p.{key}', *(f'p.{name}' for name in shared), created_at])
+    conn.execute(f'INSERT INTO patients_canonical ({columns}) SELECT {values} FROM patients p')
+    conn.execute('DROP TABLE patients')
+    conn.execute('ALTER TABLE patients_canonical RENAME TO patients')
+
+    # Older app versions also wrote foreign keys to patients(id) and
+    # therapy_sessions(session_id); rebuild those tables from the canonical DDL
+    for table, ddl in TABLES.items():
+        references = {(row[2], row[4]) for row in conn.execute(f"PRAGMA foreign_key_list({table})")}
+        if not references & STALE_FOREIGN_KEYS:
+            continue
+        rebuilt = f'{table}_rebuilt'
+        conn.execute(ddl.format(table=rebuilt))
+        column_list = ', '.join(name for name in _columns(conn, rebuilt) if name in _columns(conn, table))
+        conn.execute(f'INSERT INTO {rebuilt} ({column_list}) SELECT {column_list} FROM {table}')
+        conn.execute(f'DROP TABLE {table}')
+        conn.execute(f'ALTER TABLE {rebuilt} RENAME TO {table}')
+
+
+# (name, table, columns) of the secondary indexes on the therapy tables; the
+# date columns run in the ORDER BY direction of the patient data loads, so
+# SQLite reads them in index order without a sort
+INDEXES: List[Tuple[str, str, str]] = [
+    ('idx_therapy_sessions_patient_date_desc', 'therapy_sessions', 'patient_id, session_date DESC'),
+    ('idx_sessions_patient_created', 'sessions', 'patient_id, created_at'),
+    ('idx_big5_scores_patient_created_desc', 'big5_scores', 'patient_id, created_at DESC, id DESC'),
+    ('idx_therapy_recommendations_patient_category', 'therapy_recommendations', 'patient_id, category, rank'),
+    ('idx_therapy_feedback_patient_created_desc', 'therapy_feedback', 'patient_id, created_at DESC'),
+    ('idx_therapy_feedback_condition_created', 'therapy_feedback', 'condition, created_at'),
+]
+
+
+def _create_indexes(conn: sqlite3.Connection):
+    """Composite indexes for the per-patient, date-ordered lookups"""
+    for name, table, columns in INDEXES:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+
+
+def _create_patient_list_index(conn: sqlite3.Connection):
+    """Keyset pagination index for the patient list ordered by registration date"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_patients_created ON patients (created_at, patient_id)")
+    # Gather planner statistics once, after every index exists
+    conn.execute('ANALYZE')
+
+
+# (version, description, migration); versions are applied in order
+MIGRATIONS: List[Tuple[int, str, Callable[[sqlite3.Connection], None]]] = [
+    (1, "create tables", _create_tables),
+    (2, "canonical patient_id schema for patients", _canonical_patients),
+    (3, "patient_id/date indexes on therapy tables", _create_indexes),
+    (4, "patient list pagination index", _create_patient_list_index),
+]
+
+# Queries the app runs, shared with HOT_QUERIES so the plan check covers the
+# exact SQL. {where} is '' or a "WHERE patient_id IN (...)" filter.
+PATIENT_ROWS_SQL = "SELECT patient_id, name, age, condition, created_at FROM patients {where}"
+PATIENT_SESSIONS_SQL = ("SELECT patient_id, id, session_date, recommendations_count FROM therapy_sessions {where} "
+                        "ORDER BY patient_id, session_date DESC")
+PATIENT_RECOMMENDATIONS_SQL = ("SELECT patient_id, category, song_title, video_id, channel, rank "
+                               "FROM therapy_recommendations {where} ORDER BY patient_id, category, rank")
+PATIENT_FEEDBACK_SQL = ("SELECT patient_id, feedback_type, reward, created_at FROM therapy_feedback {where} "
+                        "ORDER BY patient_id, created_at DESC")
+LATEST_BIG5_SQL = ("SELECT patient_id, openness, conscientiousness, extraversion, agreeableness, neuroticism, "
+                   "reinforcement_learning FROM ("
+                   "SELECT *, ROW_NUMBER() OVER (PARTITION BY patient_id ORDER BY created_at DESC, id DESC) AS rn "
+                   "FROM big5_scores {where}) WHERE rn = 1")
+PATIENT_DETAIL_BIG5_SQL = "SELECT * FROM big5_scores WHERE patient_id = ? ORDER BY created_at DESC LIMIT 1"
+PATIENT_DETAIL_SESSIONS_SQL = "SELECT * FROM therapy_sessions WHERE patient_id = ? ORDER BY session_date DESC"
+DELETE_PATIENT_SESSIONS_SQL = "DELETE FROM therapy_sessions WHERE patient_id = ?"
+PATIENT_PAGE_SQL = "SELECT p.patient_id, {key_list} FROM patients p {joins} {where} {keyset} ORDER BY {order} LIMIT ?"
+PATIENT_COUNT_SQL = "SELECT COUNT(*) FROM patients p {where}"
+# Patient list filters; the name search is a Unicode-folded substring match
+PATIENT_NAME_FILTER = "casefold(p.name) LIKE ? ESCAPE '\\'"
+PATIENT_CONDITION_FILTER = "p.condition LIKE ? ESCAPE '\\'"
+# {joins} of the "Most Sessions" and "Most Feedback" patient list sorts
+PATIENT_SESSION_COUNTS_JOIN = ("LEFT JOIN (SELECT patient_id, COUNT(*) AS session_count FROM therapy_sessions "
+                               "GROUP BY patient_id) s ON s.patient_id = p.patient_id")
+PATIENT_FEEDBACK_COUNTS_JOIN = ("LEFT JOIN (SELECT patient_id, COUNT(*) AS feedback_count FROM therapy_feedback "
+                                "GROUP BY patient_id) f ON f.patient_id = p.patient_id")
+
+# The feedback log as replay.py and the model_store.py rebuild stream it;
+# {where} is '' or adds "AND condition = ?" and the window "AND created_at >= ?"
+FEEDBACK_LOG_SQL = ("SELECT condition, context_features, reward FROM therapy_feedback "
+                    "WHERE context_features IS NOT NULL {where}")
+FEEDBACK_CONDITIONS_SQL = "SELECT DISTINCT condition FROM therapy_feedback"
+
+_SOME_PATIENTS = "WHERE patient_id IN (?, ?, ?)"
+
+
+def sql_casefold(value):
+    """casefold() SQL function: Unicode case folding of text values"""
+    return value.casefold() if isinstance(value, str) else value
+
+
+# (name, query) pairs that must be answered through an index without a temp
+# sort, apart from the plan lines LINEAR_PLANS accepts for them
+HOT_QUERIES: List[Tuple[str, str]] = [
+    ('all patients', PATIENT_ROWS_SQL.format(where='') + " ORDER BY created_at DESC"),
+    ('page patients', PATIENT_ROWS_SQL.format(where=_SOME_PATIENTS)),
+    ('all sessions', PATIENT_SESSIONS_SQL.format(where='')),
+    ('page sessions', PATIENT_SESSIONS_SQL.format(where=_SOME_PATIENTS)),
+    ('all recommendations', PATIENT_RECOMMENDATIONS_SQL.format(where='')),
+    ('page recommendations', PATIENT_RECOMMENDATIONS_SQL.format(where=_SOME_PATIENTS)),
+    ('all feedback', PATIENT_FEEDBACK_SQL.format(where='')),
+    ('page feedback', PATIENT_FEEDBACK_SQL.format(where=_SOME_PATIENTS)),
+    ('all latest big5', LATEST_BIG5_SQL.format(where='')),
+    ('page latest big5', LATEST_BIG5_SQL.format(where=_SOME_PATIENTS)),
+    ('patient detail big5', PATIENT_DETAIL_BIG5_SQL),
+    ('patient detail sessions', PATIENT_DETAIL_SESSIONS_SQL),
+    ('delete patient sessions', DELETE_PATIENT_SESSIONS_SQL),
+    ('latest patients page', PATIENT_PAGE_SQL.format(
+        key_list='p.created_at, p.patient_id', joins='', where='',
+        keyset='WHERE (p.created_at, p.patient_id) < (?, ?)',
+        order='p.created_at DESC, p.patient_id DESC')),
+    ('patients page by name', PATIENT_PAGE_SQL.format(
+        key_list='p.created_at, p.patient_id', joins='', where=f"WHERE {PATIENT_NAME_FILTER}",
+        keyset='AND (p.created_at, p.patient_id) < (?, ?)',
+        order='p.created_at DESC, p.patient_id DESC')),
+    ('replay condition feedback', FEEDBACK_LOG_SQL.format(where='AND condition = ?') + ' ORDER BY created_at, id'),
+    ('rebuild window feedback', FEEDBACK_LOG_SQL.format(where='AND condition = ? AND created_at >= ?')),
+    ('feedback conditions', FEEDBACK_CONDITIONS_SQL),
+    ('count patients', PATIENT_COUNT_SQL.format(where='')),
+    ('count patients by name', PATIENT_COUNT_SQL.format(where=f"WHERE {PATIENT_NAME_FILTER}")),
+    ('patients page by sessions', PATIENT_PAGE_SQL.format(
+        key_list='COALESCE(s.session_count, 0), p.created_at, p.patient_id', joins=PATIENT_SESSION_COUNTS_JOIN,
+        where='', keyset='WHERE (COALESCE(s.session_count, 0), p.created_at, p.patient_id) < (?, ?, ?)',
+        order='COALESCE(s.session_count, 0) DESC, p.created_at DESC, p.patient_id DESC')),
+    ('patients page by feedback', PATIENT_PAGE_SQL.format(
+        key_list='COALESCE(f.feedback_count, 0), p.created_at, p.patient_id', joins=PATIENT_FEEDBACK_COUNTS_JOIN,
+        where='', keyset='WHERE (COALESCE(f.feedback_count, 0), p.created_at, p.patient_id) < (?, ?, ?)',
+        order='COALESCE(f.feedback_count, 0) DESC, p.created_at DESC, p.patient_id DESC')),
+]
+
+# Plan lines accepted for HOT_QUERIES that are O(N) by design. A substring
+# name search cannot seek an index, so counting its matches reads every
+# patient; sorting by session or feedback count aggregates the whole table
+# (through its patient_id index) and sorts every patient for each page. The
+# patient list counts matches once per filter change, not once per page.
+LINEAR_PLANS: Dict[str, Tuple[str, ...]] = {
+    'count patients by name': ('SCAN p',),
+    'patients page by sessions': ('USE TEMP B-TREE FOR ORDER BY',),
+    'patients page by feedback': ('USE TEMP B-TREE FOR ORDER BY',),
+}
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(db_path: str) -> int:
+    """Bring the database up to LATEST_VERSION; returns the number of migrations applied"""
+    conn = sqlite3.connect(str(db_path), timeout=30.0, isolation_level=None)
+    applied = 0
+    try:
+        if schema_version(conn) >= LATEST_VERSION:
+            return 0
+        for version, description, migration in MIGRATIONS:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Re-read under the write lock; another process may have migrated meanwhile
+                if schema_version(conn) >= version:
+                    conn.execute('ROLLBACK')
+                    continue
+                migration(conn)
+                conn.execute(f'PRAGMA user_version = {int(version)}')
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            applied += 1
+            print(f"Applied migration {version}: {description}")
+    finally:
+        conn.close()
+    return applied
+
+
+def _empty_schema_copy(conn: sqlite3.Connection) -> sqlite3.Connection:
+    """In-memory database with the tables and indexes of conn but no rows or ANALYZE statistics"""
+    copy = sqlite3.connect(':memory:')
+    for (sql,) in conn.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL "
+                               "AND name NOT LIKE 'sqlite_%' ORDER BY type = 'index'"):
+        copy.execute(sql)
+    copy.create_function('casefold', 1, sql_casefold, deterministic=True)
+    return copy
+
+
+def check_query_plans(conn: sqlite3.Connection) -> List[str]:
+    """EXPLAIN QUERY PLAN every hot query; returns a message per full table scan or temp sort.
+
+    Plans are taken on an empty copy of the schema: statistics gathered on a
+    small database make a scan the cheapest plan, and the check is about
+    whether an index serves each query once the tables have grown.
+    """
+    problems = []
+    schema = _empty_schema_copy(conn)
+    try:
+        for name, query in HOT_QUERIES:
+            params = (None,) * query.count('?')
+            problems.extend(f"{name}: {detail}" for detail in _plan_problems(schema, query, params)
+                            if detail not in LINEAR_PLANS.get(name, ()))
+    finally:
+        schema.close()
+    return problems
+
+
+def _plan_problems(conn: sqlite3.Connection, query: str, params: Tuple) -> List[str]:
+    problems = []
+    for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params):
+        detail = row[-1]
+        # SCAN (subquery-N) reads a co-routine's output, not a table
+        full_scan = detail.startswith('SCAN ') and 'USING' not in detail and not detail.startswith('SCAN (')
+        if full_scan or 'USE TEMP B-TREE' in detail:
+            problems.append(detail)
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply TheraMuse database migrations")
+    parser.add_argument('--db', default="theramuse.db", help="SQLite database to migrate")
+    parser.add_argument('--check-plans', action='store_true',
+                        help="Fail if a hot query would scan a whole table")
+    args = parser.parse_args(argv)
+
+    applied = migrate(args.db)
+    conn = sqlite3.connect(args.db)
+    try:
+        version = schema_version(conn)
+        problems = check_query_plans(conn) if args.check_plans else []
+    finally:
+        conn.close()
+    print(f"{args.db}: {applied} migration(s) applied, schema version {version}")
+
+    for problem in problems:
+        print(f"Full scan: {problem}")
+    if args.check_plans:
+        print("Query plans OK" if not problems else f"{len(problems)} hot query plan(s) need an index")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,443 @@
+"""Versioned on-disk format for the per-condition bandit model.
+
+Layout of a model file::
+
+    b"TMMODEL\\0" | header length (uint64, little endian) | JSON header | padding | raw arrays
+
+The JSON header records the format version, model metadata and, for every
+condition, the scalar bandit parameters plus the byte offset and shape of its
+B, mu and f arrays. Arrays are little-endian float64, 64-byte aligned, and are
+opened with np.memmap, so loading cost does not depend on model size and no
+code is ever executed while reading a model.
+
+The header also lists the spool files (see bandit.save_deltas) already folded
+into the arrays, so merging a spool is exactly-once even if the process dies
+between saving the model and deleting the files.
+
+Run ``python model_store.py convert theramuse_model.pkl theramuse_model.bin``
+to migrate an existing pickle, ``python model_store.py merge`` to fold a delta
+spool into the model, or ``python model_store.py rebuild`` to recompute every
+condition's bandit from the therapy_feedback log. The rebuild also rewrites
+theramuse_model.pkl, the pickle the app's TheraMuse backend loads at startup,
+so it restores a corrupt or lost model for the running app too.
+"""
+
+import argparse
+import copyreg
+import json
+import os
+import pickle
+import sqlite3
+import struct
+import tempfile
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterable, Optional
+
+import numpy as np
+
+from bandit import LinearThompsonSampling, merge_spooled_deltas, remove_spool_files
+from migrations import FEEDBACK_CONDITIONS_SQL, FEEDBACK_LOG_SQL
+
+MAGIC = b"TMMODEL\0"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+ARRAY_DTYPE = np.dtype('<f8')
+ARRAY_NAMES = ('B', 'mu', 'f')
+DEFAULT_MODEL_PATH = Path("theramuse_model.bin")
+# The pickle the TheraMuse backend loads and saves, and its bandit attributes
+LEGACY_MODEL_PATH = Path("theramuse_model.pkl")
+LEGACY_BANDIT_KEYS = ('n_features', 'alpha', 'lambda_reg', 'B', 'mu', 'f', 'n_interactions', 'total_reward')
+# exploration_rate of the shipped model, for rebuilds with no previous model to read it from
+DEFAULT_EXPLORATION_RATE = 0.3
+CONDITIONS = ('dementia', 'down_syndrome', 'adhd')
+
+_PREFIX = struct.Struct('<8sQ')
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _bandit_state(bandit) -> Dict:
+    """Accept a LinearThompsonSampling, a legacy pickled bandit or a plain state dict"""
+    if isinstance(bandit, dict):
+        return bandit
+    if isinstance(bandit, LinearThompsonSampling):
+        return bandit.__getstate__()
+    return vars(bandit)
+
+
+def _atomic_write(path: Path, write: Callable[[BinaryIO], None]) -> Path:
+    """Write a file through write(fh) into a temp file, then rename it over path"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            write(fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def save_model(path: str, bandits: Dict, exploration_rate: Optional[float] = None,
+               saved_at: Optional[str] = None, merged_spool: Iterable[str] = ()) -> Path:
+    """Atomically write bandits (condition -> bandit or state dict) to path.
+
+    ``merged_spool`` names the spool files whose deltas the bandits contain.
+    """
+    path = Path(path)
+    header = {
+        'format': 'theramuse-model',
+        'version': FORMAT_VERSION,
+        'saved_at': saved_at or datetime.now().isoformat(),
+        'exploration_rate': exploration_rate,
+        'merged_spool': sorted(merged_spool),
+        'bandits': {},
+    }
+
+    arrays = []
+    for condition, bandit in bandits.items():
+        state = _bandit_state(bandit)
+        entry = {
+            'n_features': int(state['n_features']),
+            'alpha': float(state['alpha']),
+            'lambda_reg': float(state['lambda_reg']),
+            'decay': float(state.get('decay', 1.0)),
+            'n_interactions': int(state.get('n_interactions', 0)),
+            'total_reward': float(state.get('total_reward', 0.0)),
+            'arrays': {},
+        }
+        for name in ARRAY_NAMES:
+            array = np.ascontiguousarray(state[name], dtype=ARRAY_DTYPE)
+            entry['arrays'][name] = {'shape': list(array.shape)}
+            arrays.append((entry['arrays'][name], array))
+        header['bandits'][condition] = entry
+
+    # Offsets depend on the header length, which depends on the offsets;
+    # reserve room for a 16-digit offset per array up front.
+    for entry, _ in arrays:
+        entry['offset'] = 0
+    data_start = _align(_PREFIX.size + len(json.dumps(header).encode('utf-8')) + 16 * len(arrays))
+    offset = data_start
+    for entry, array in arrays:
+        entry['offset'] = offset
+        offset = _align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    if _PREFIX.size + len(header_bytes) > data_start:
+        raise ValueError("Model header does not fit in the reserved space")
+
+    def write(fh):
+        fh.write(_PREFIX.pack(MAGIC, len(header_bytes)))
+        fh.write(header_bytes)
+        for entry, array in arrays:
+            fh.write(b"\0" * (entry['offset'] - fh.tell()))
+            fh.write(array.tobytes())
+    return _atomic_write(path, write)
+
+
+def read_header(path: str) -> Dict:
+    """Read and validate the JSON header of a model file"""
+    with open(path, 'rb') as fh:
+        prefix = fh.read(_PREFIX.size)
+        if len(prefix) != _PREFIX.size:
+            raise ValueError(f"{path} is not a TheraMuse model file")
+        magic, header_len = _PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a TheraMuse model file")
+        header = json.loads(fh.read(header_len).decode('utf-8'))
+
+    version = header.get('version')
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported model format version {version} (expected {FORMAT_VERSION})")
+    return header
+
+
+def load_model(path: str) -> Dict:
+    """Open a model file; B, mu and f are read-only memory maps into it.
+
+    Returns a dict shaped like the legacy pickle: ``saved_at``,
+    ``exploration_rate`` and ``bandits`` (condition -> state dict), plus
+    ``merged_spool``.
+    """
+    header = read_header(path)
+    bandits = {}
+    for condition, entry in header['bandits'].items():
+        state = {key: value for key, value in entry.items() if key != 'arrays'}
+        for name, spec in entry['arrays'].items():
+            state[name] = np.memmap(path, dtype=ARRAY_DTYPE, mode='r',
+                                    offset=spec['offset'], shape=tuple(spec['shape']))
+        bandits[condition] = state
+    return {
+        'saved_at': header.get('saved_at'),
+        'exploration_rate': header.get('exploration_rate'),
+        'merged_spool': header.get('merged_spool', []),
+        'bandits': bandits,
+    }
+
+
+def load_bandits(path: str) -> Dict[str, LinearThompsonSampling]:
+    """Load every condition's state from a model file as a live bandit"""
+    model = load_model(path)
+    return {condition: LinearThompsonSampling.from_state(state)
+            for condition, state in model['bandits'].items()}
+
+
+def merge_spool(path: str, spool_dir: str) -> int:
+    """Fold a delta spool into the model at path exactly once; returns events merged.
+
+    The merged file names are saved in the model header before the files are
+    deleted. If the process dies after the save, the next call skips the
+    files named there and only finishes deleting them.
+    """
+    model = load_model(path)
+    bandits = {condition: LinearThompsonSampling.from_state(state)
+               for condition, state in model['bandits'].items()}
+    merged, paths, _ = merge_spooled_deltas(bandits, spool_dir, model['merged_spool'])
+    if merged:
+        save_model(path, bandits, exploration_rate=model['exploration_rate'],
+                   merged_spool=[p.name for p in paths])
+    remove_spool_files(paths)
+    return merged
+
+
+class _LegacyBandit:
+    """Attribute holder standing in for main.LinearThompsonSampling while unpickling"""
+
+
+class _LegacyModelUnpickler(pickle.Unpickler):
+    """Unpickler that only resolves the globals theramuse_model.pkl needs"""
+
+    ALLOWED = {
+        ('numpy._core.multiarray', '_reconstruct'),
+        ('numpy.core.multiarray', '_reconstruct'),
+        ('numpy._core.multiarray', 'scalar'),
+        ('numpy.core.multiarray', 'scalar'),
+        ('numpy', 'ndarray'),
+        ('numpy', 'dtype'),
+    }
+
+    def find_class(self, module, name):
+        if name == 'LinearThompsonSampling' and module in ('main', 'ml', 'bandit'):
+            return _LegacyBandit
+        if (module, name) in self.ALLOWED:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from a model pickle")
+
+
+class _LegacyModelPickler(pickle.Pickler):
+    """Pickler that writes _LegacyBandit as main.LinearThompsonSampling, the class the backend unpickles.
+
+    main is not importable here, so that class cannot be pickled by name:
+    dump() writes the main.LinearThompsonSampling global itself into memo
+    slot 0, and reducer_override turns every _LegacyBandit into a NEWOBJ of
+    that slot plus its attribute dict.
+    """
+
+    def __init__(self, file: BinaryIO, protocol: int = 4):
+        super().__init__(file, protocol)
+        self._file = file
+        self.memo = {id(_LegacyBandit): (0, _LegacyBandit)}
+
+    def reducer_override(self, obj):
+        if isinstance(obj, _LegacyBandit):
+            return copyreg.__newobj__, (_LegacyBandit,), dict(vars(obj))
+        return NotImplemented
+
+    def dump(self, obj):
+        self._file.write(pickle.GLOBAL + b"main\nLinearThompsonSampling\n" + pickle.PUT + b"0\n" + pickle.POP)
+        super().dump(obj)
+
+
+def save_legacy_pickle(path: str, bandits: Dict, exploration_rate: Optional[float] = None,
+                       saved_at: Optional[str] = None) -> Path:
+    """Atomically write bandits in the theramuse_model.pkl layout the backend loads"""
+    legacy_bandits = {}
+    for condition, bandit in bandits.items():
+        state = _bandit_state(bandit)
+        legacy = _LegacyBandit()
+        for key in LEGACY_BANDIT_KEYS:
+            value = state[key]
+            legacy.__dict__[key] = np.array(value, dtype=float) if key in ARRAY_NAMES else value
+        legacy_bandits[condition] = legacy
+    model = {
+        'bandits': legacy_bandits,
+        'exploration_rate': exploration_rate,
+        'saved_at': saved_at or datetime.now().isoformat(),
+    }
+    return _atomic_write(Path(path), lambda fh: _LegacyModelPickler(fh, protocol=4).dump(model))
+
+
+def convert_pickle(pkl_path: str, out_path: str) -> Path:
+    """Convert a legacy theramuse_model.pkl to the versioned format"""
+    with open(pkl_path, 'rb') as fh:
+        legacy = _LegacyModelUnpickler(fh).load()
+    return save_model(
+        out_path,
+        legacy['bandits'],
+        exploration_rate=legacy.get('exploration_rate'),
+        saved_at=legacy.get('saved_at'),
+    )
+
+
+def _parse_contexts(features: Iterable[str]) -> Optional[np.ndarray]:
+    """Parse a chunk of JSON context vectors in one call; None if any row is malformed"""
+    try:
+        X = np.array(json.loads('[' + ','.join(features) + ']'), dtype=float)
+    except (TypeError, ValueError):
+        return None
+    return X if X.ndim == 2 else None
+
+
+def rebuild_from_feedback(db_path: str, window_days: Optional[float] = None, lambda_reg: float = 1.0,
+                          alpha: float = 1.0, n_features: int = 20,
+                          chunk_size: int = 50000) -> Dict[str, LinearThompsonSampling]:
+    """Recompute each condition's bandit from therapy_feedback.
+
+    Rows are read in chunks, stacked into a matrix X per condition and folded
+    in with B = lambda_reg * I + X^T X and f = X^T r, so a rebuild costs a few
+    GEMMs per chunk rather than one update per event. Only feedback from the
+    last ``window_days`` days is used when given.
+    """
+    B = {}
+    f = {}
+    counts = {}
+    rewards = {}
+
+    def accumulate(condition: str, X: np.ndarray, r: np.ndarray):
+        if condition not in B:
+            B[condition] = lambda_reg * np.eye(n_features)
+            f[condition] = np.zeros(n_features)
+            counts[condition] = 0
+            rewards[condition] = 0.0
+        B[condition] += X.T @ X
+        f[condition] += X.T @ r
+        counts[condition] += X.shape[0]
+        rewards[condition] += float(r.sum())
+
+    def read(cursor: sqlite3.Cursor):
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            conditions = np.array([row[0] for row in rows])
+            r = np.array([row[2] for row in rows], dtype=float)
+            X = _parse_contexts(row[1] for row in rows)
+            if X is None or X.shape[1] != n_features:
+                # Fall back to row-by-row parsing to skip malformed vectors
+                keep = []
+                vectors = []
+                for i, row in enumerate(rows):
+                    vector = _parse_contexts([row[1]])
+                    if vector is not None and vector.shape[1] == n_features:
+                        keep.append(i)
+                        vectors.append(vector[0])
+                if not keep:
+                    continue
+                X = np.array(vectors)
+                conditions = conditions[keep]
+                r = r[keep]
+            for condition in np.unique(conditions):
+                mask = conditions == condition
+                accumulate(str(condition), X[mask], r[mask])
+
+    conn = sqlite3.connect(db_path)
+    try:
+        if window_days is None:
+            read(conn.execute(FEEDBACK_LOG_SQL.format(where='')))
+        else:
+            # One range read of the (condition, created_at) index per condition
+            # instead of scanning the whole log for the window
+            since = (datetime.now(timezone.utc) - timedelta(days=window_days)).strftime('%Y-%m-%d %H:%M:%S')
+            window_sql = FEEDBACK_LOG_SQL.format(where='AND condition = ? AND created_at >= ?')
+            for (condition,) in conn.execute(FEEDBACK_CONDITIONS_SQL).fetchall():
+                read(conn.execute(window_sql, (condition, since)))
+    finally:
+        conn.close()
+
+    bandits = {}
+    for condition in sorted(set(CONDITIONS) | set(B)):
+        if condition in B:
+            bandits[condition] = LinearThompsonSampling.from_state({
+                'n_features': n_features,
+                'alpha': alpha,
+                'lambda_reg': lambda_reg,
+                'B': B[condition],
+                'f': f[condition],
+                'n_interactions': counts[condition],
+                'total_reward': rewards[condition],
+            })
+        else:
+            bandits[condition] = LinearThompsonSampling(n_features, alpha=alpha, lambda_reg=lambda_reg)
+    return bandits
+
+
+def _previous_exploration_rate(model_path: str, legacy_path: str) -> float:
+    """exploration_rate of the model being replaced, falling back to DEFAULT_EXPLORATION_RATE"""
+    rate = None
+    try:
+        if Path(model_path).exists():
+            rate = read_header(model_path).get('exploration_rate')
+        if rate is None and legacy_path and Path(legacy_path).exists():
+            with open(legacy_path, 'rb') as fh:
+                rate = _LegacyModelUnpickler(fh).load().get('exploration_rate')
+    except Exception as e:
+        # A corrupt model is what a rebuild recovers from
+        print(f"Could not read the previous exploration rate: {e}")
+    return DEFAULT_EXPLORATION_RATE if rate is None else rate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="TheraMuse model file maintenance")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert = subparsers.add_parser('convert', help="Convert a legacy model pickle")
+    convert.add_argument('pickle_path', nargs='?', default="theramuse_model.pkl")
+    convert.add_argument('out_path', nargs='?', default=str(DEFAULT_MODEL_PATH))
+
+    show = subparsers.add_parser('show', help="Print a model file header")
+    show.add_argument('path', nargs='?', default=str(DEFAULT_MODEL_PATH))
+
+    merge = subparsers.add_parser('merge', help="Fold spooled deltas into a model file")
+    merge.add_argument('spool_dir')
+    merge.add_argument('path', nargs='?', default=str(DEFAULT_MODEL_PATH))
+
+    rebuild = subparsers.add_parser('rebuild', help="Rebuild every bandit from therapy_feedback")
+    rebuild.add_argument('--db', default="theramuse.db")
+    rebuild.add_argument('--out', default=str(DEFAULT_MODEL_PATH))
+    rebuild.add_argument('--legacy-out', default=str(LEGACY_MODEL_PATH),
+                         help="Also write the pickle the app's backend loads ('' to skip)")
+    rebuild.add_argument('--window-days', type=float, help="Only use feedback from the last N days")
+    rebuild.add_argument('--lambda-reg', type=float, default=1.0)
+    rebuild.add_argument('--alpha', type=float, default=1.0)
+    rebuild.add_argument('--n-features', type=int, default=20)
+    rebuild.add_argument('--chunk-size', type=int, default=50000)
+
+    args = parser.parse_args(argv)
+    if args.command == 'rebuild':
+        bandits = rebuild_from_feedback(args.db, args.window_days, args.lambda_reg, args.alpha,
+                                        args.n_features, args.chunk_size)
+        exploration_rate = _previous_exploration_rate(args.out, args.legacy_out)
+        path = save_model(args.out, bandits, exploration_rate=exploration_rate)
+        for condition, bandit in bandits.items():
+            print(f"{condition}: {bandit.n_interactions} feedback events")
+        print(f"Wrote {path}")
+        if args.legacy_out:
+            print(f"Wrote {save_legacy_pickle(args.legacy_out, bandits, exploration_rate=exploration_rate)}")
+    elif args.command == 'convert':
+        path = convert_pickle(args.pickle_path, args.out_path)
+        print(f"Wrote {path}")
+    elif args.command == 'merge':
+        print(f"Merged {merge_spool(args.path, args.spool_dir)} feedback events into {args.path}")
+    elif args.command == 'show':
+        print(json.dumps(read_header(args.path), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Token-bucket rate limiting with priority classes for outbound searches.
+
+Each upstream gets one bucket (``get_rate_limiter``). Requests acquire a
+token in one of three classes: INTERACTIVE (a clinician waiting on an
+intake), REFRESH (background refresh of stale results) and BACKGROUND
+(prefetch jobs such as cache warm-up). A request only proceeds when no
+higher class is waiting, and the lower classes must leave a reserve of
+tokens in the bucket, so background work never spends the burst capacity
+that interactive requests need.
+"""
+
+import threading
+import time
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+INTERACTIVE = 0
+REFRESH = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: 'interactive', REFRESH: 'refresh', BACKGROUND: 'background'}
+
+DEFAULT_RATE = 10.0
+DEFAULT_BURST = 20
+# Fraction of the burst each class must leave in the bucket
+DEFAULT_RESERVE = {INTERACTIVE: 0.0, REFRESH: 0.25, BACKGROUND: 0.5}
+
+_limiters: Dict[str, 'TokenBucketLimiter'] = {}
+_limiters_lock = threading.Lock()
+
+
+class RateLimitExceeded(RuntimeError):
+    """No token became available within the caller's timeout"""
+
+
+class TokenBucketLimiter:
+    """Token bucket refilled at ``rate`` per second up to ``burst`` tokens"""
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = DEFAULT_BURST,
+                 reserve: Optional[Dict[int, float]] = None):
+        self.rate = rate
+        self.burst = burst
+        reserve = DEFAULT_RESERVE if reserve is None else reserve
+        self._reserve = {priority: reserve.get(priority, 0.0) * burst for priority in PRIORITY_NAMES}
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiting = {priority: 0 for priority in PRIORITY_NAMES}
+        self._max_waiting = {priority: 0 for priority in PRIORITY_NAMES}
+        self.granted = {priority: 0 for priority in PRIORITY_NAMES}
+        self.rejected = {priority: 0 for priority in PRIORITY_NAMES}
+        self.wait_seconds = {priority: 0.0 for priority in PRIORITY_NAMES}
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _higher_waiting(self, priority: int) -> bool:
+        return any(self._waiting[p] for p in PRIORITY_NAMES if p < priority)
+
+    def acquire(self, priority: int = INTERACTIVE, timeout: Optional[float] = None) -> bool:
+        """Take one token, waiting up to timeout seconds (None waits indefinitely)"""
+        start = time.monotonic()
+        deadline = None if timeout is None else start + timeout
+        with self._cond:
+            self._waiting[priority] += 1
+            self._max_waiting[priority] = max(self._max_waiting[priority], self._waiting[priority])
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    needed = 1.0 + self._reserve[priority] - self._tokens
+                    if needed <= 0 and not self._higher_waiting(priority):
+                        self._tokens -= 1.0
+                        self.granted[priority] += 1
+                        self.wait_seconds[priority] += now - start
+                        return True
+                    if deadline is not None and now >= deadline:
+                        self.rejected[priority] += 1
+                        return False
+                    # Higher classes notify when they leave; otherwise sleep until refilled.
+                    # None waits for a notify, but never past the deadline
+                    delay = needed / self.rate if needed > 0 and self.rate > 0 else None
+                    if deadline is not None:
+                        delay = deadline - now if delay is None else min(delay, deadline - now)
+                    self._cond.wait(delay)
+            finally:
+                self._waiting[priority] -= 1
+                self._cond.notify_all()
+
+    def status(self) -> Dict:
+        """Tokens, queue depth and grant/reject counters per priority class"""
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                'rate': self.rate,
+                'burst': self.burst,
+                'tokens': round(self._tokens, 2),
+                'queue_depth': {PRIORITY_NAMES[p]: n for p, n in self._waiting.items()},
+                'max_queue_depth': {PRIORITY_NAMES[p]: n for p, n in self._max_waiting.items()},
+                'granted': {PRIORITY_NAMES[p]: n for p, n in self.granted.items()},
+                'rejected': {PRIORITY_NAMES[p]: n for p, n in self.rejected.items()},
+                'mean_wait_seconds': {
+                    PRIORITY_NAMES[p]: (self.wait_seconds[p] / self.granted[p]) if self.granted[p] else 0.0
+                    for p in PRIORITY_NAMES
+                },
+            }
+
+
+def get_rate_limiter(upstream: Optional[str], rate: float = DEFAULT_RATE,
+                     burst: int = DEFAULT_BURST) -> TokenBucketLimiter:
+    """The process-wide bucket for an upstream (keyed by host); created on first use"""
+    key = urlparse(upstream or '').netloc or (upstream or '')
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = TokenBucketLimiter(rate, burst)
+        return _limiters[key]
@@ -0,0 +1,235 @@
+"""Offline replay benchmark for bandit policies over the therapy_feedback log.
+
+Each logged event is a (condition, context, reward) triple. Every policy keeps
+one model per condition and, for each event in time order, decides whether it
+would have recommended that song (score >= 0). Following the replay method,
+a policy only earns the reward and learns from the event when it would have
+played it.
+
+Reported per policy:
+  - cumulative reward of the events it played
+  - regret proxy: sum over events of max(reward, 0) - reward if played
+    (positive feedback it passed on plus negative feedback it incurred)
+  - mean squared error of its mean-reward estimate before each update
+  - model updates per second
+
+Usage: ``python replay.py --db theramuse.db --repeat 100``
+"""
+
+import argparse
+import json
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from bandit import LinearThompsonSampling
+from migrations import FEEDBACK_LOG_SQL
+
+N_FEATURES = 20
+
+
+def iter_feedback(db_path: str, condition: Optional[str] = None,
+                  chunk_size: int = 1000) -> Iterator[Tuple[str, np.ndarray, float]]:
+    """Stream (condition, context, reward) from therapy_feedback in time order"""
+    conn = sqlite3.connect(db_path)
+    try:
+        cursor = conn.cursor()
+        where, params = ('AND condition = ?', (condition,)) if condition else ('', ())
+        cursor.execute(FEEDBACK_LOG_SQL.format(where=where) + ' ORDER BY created_at, id', params)
+
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row_condition, features, reward in rows:
+                try:
+                    context = np.asarray(json.loads(features), dtype=float)
+                except (TypeError, ValueError):
+                    continue
+                if context.ndim != 1:
+                    continue
+                yield row_condition, context, float(reward)
+    finally:
+        conn.close()
+
+
+class Policy(ABC):
+    """Base class: per-condition models created on first use"""
+
+    name = "policy"
+
+    def __init__(self, n_features: int = N_FEATURES, seed: Optional[int] = None):
+        self.n_features = n_features
+        self._rng = np.random.default_rng(seed)
+        self._models: Dict[str, object] = {}
+
+    def model(self, condition: str):
+        if condition not in self._models:
+            self._models[condition] = self.new_model()
+        return self._models[condition]
+
+    @abstractmethod
+    def new_model(self):
+        """A fresh model for one condition"""
+
+    @abstractmethod
+    def score(self, condition: str, context: np.ndarray) -> float:
+        """Decision score; the policy plays the event when this is >= 0"""
+
+    def estimate(self, condition: str, context: np.ndarray) -> float:
+        """Mean reward estimate used for the accuracy metric"""
+        return float(context @ self.model(condition).mu)
+
+    def update(self, condition: str, context: np.ndarray, reward: float):
+        self.model(condition).update(context, reward)
+
+
+class LinTSPolicy(Policy):
+    """The production Linear Thompson Sampling bandit"""
+
+    name = "lints"
+
+    def __init__(self, n_features: int = N_FEATURES, seed: Optional[int] = None,
+                 alpha: float = 1.0, lambda_reg: float = 1.0):
+        super().__init__(n_features, seed)
+        self.alpha = alpha
+        self.lambda_reg = lambda_reg
+
+    def new_model(self):
+        return LinearThompsonSampling(self.n_features, alpha=self.alpha, lambda_reg=self.lambda_reg,
+                                      seed=int(self._rng.integers(2 ** 32)))
+
+    def score(self, condition: str, context: np.ndarray) -> float:
+        return self.model(condition).predict(context)
+
+
+class LinUCBPolicy(LinTSPolicy):
+    """Optimistic upper confidence bound on the same posterior"""
+
+    name = "linucb"
+
+    def score(self, condition: str, context: np.ndarray) -> float:
+        model = self.model(condition)
+        return float(context @ model.mu) + self.alpha * model.confidence_width(context)
+
+
+class EpsilonGreedyPolicy(LinTSPolicy):
+    """Greedy on the posterior mean, exploring with probability epsilon"""
+
+    name = "epsilon_greedy"
+
+    def __init__(self, n_features: int = N_FEATURES, seed: Optional[int] = None,
+                 alpha: float = 1.0, lambda_reg: float = 1.0, epsilon: float = 0.1):
+        super().__init__(n_features, seed, alpha, lambda_reg)
+        self.epsilon = epsilon
+
+    def score(self, condition: str, context: np.ndarray) -> float:
+        if self._rng.random() < self.epsilon:
+            return 0.0
+        return float(context @ self.model(condition).mu)
+
+
+class DecayedLinTSPolicy(LinTSPolicy):
+    """Linear Thompson Sampling with exponential forgetting of old feedback"""
+
+    name = "decayed_lints"
+
+    def __init__(self, n_features: int = N_FEATURES, seed: Optional[int] = None,
+                 alpha: float = 1.0, lambda_reg: float = 1.0, gamma: float = 0.99):
+        super().__init__(n_features, seed, alpha, lambda_reg)
+        self.gamma = gamma
+
+    def new_model(self):
+        return LinearThompsonSampling(self.n_features, alpha=self.alpha, lambda_reg=self.lambda_reg,
+                                      seed=int(self._rng.integers(2 ** 32)), decay=self.gamma)
+
+
+def replay(events: Iterable[Tuple[str, np.ndarray, float]], policy: Policy) -> Dict:
+    """Run one policy through the logged events and collect its metrics"""
+    n_events = 0
+    played = 0
+    cumulative_reward = 0.0
+    regret = 0.0
+    squared_error = 0.0
+    update_seconds = 0.0
+
+    for condition, context, reward in events:
+        n_events += 1
+        squared_error += (policy.estimate(condition, context) - reward) ** 2
+        play = policy.score(condition, context) >= 0.0
+        regret += max(reward, 0.0)
+        if play:
+            played += 1
+            cumulative_reward += reward
+            regret -= reward
+            start = time.perf_counter()
+            policy.update(condition, context, reward)
+            update_seconds += time.perf_counter() - start
+
+    return {
+        'policy': policy.name,
+        'events': n_events,
+        'played': played,
+        'cumulative_reward': cumulative_reward,
+        'reward_per_play': cumulative_reward / played if played else 0.0,
+        'regret_proxy': regret,
+        'mse': squared_error / n_events if n_events else 0.0,
+        'updates_per_second': played / update_seconds if update_seconds > 0 else 0.0,
+    }
+
+
+def build_policies(args) -> List[Policy]:
+    common = dict(n_features=args.n_features, seed=args.seed, alpha=args.alpha, lambda_reg=args.lambda_reg)
+    policies = {
+        'lints': lambda: LinTSPolicy(**common),
+        'linucb': lambda: LinUCBPolicy(**common),
+        'epsilon_greedy': lambda: EpsilonGreedyPolicy(epsilon=args.epsilon, **common),
+        'decayed_lints': lambda: DecayedLinTSPolicy(gamma=args.gamma, **common),
+    }
+    return [policies[name]() for name in args.policies]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay therapy_feedback through bandit policies")
+    parser.add_argument('--db', default="theramuse.db", help="SQLite database with therapy_feedback")
+    parser.add_argument('--condition', help="Only replay one condition (dementia, down_syndrome, adhd)")
+    parser.add_argument('--policies', nargs='+', default=['lints', 'linucb', 'epsilon_greedy', 'decayed_lints'],
+                        choices=['lints', 'linucb', 'epsilon_greedy', 'decayed_lints'])
+    parser.add_argument('--n-features', type=int, default=N_FEATURES)
+    parser.add_argument('--alpha', type=float, default=1.0)
+    parser.add_argument('--lambda-reg', type=float, default=1.0)
+    parser.add_argument('--epsilon', type=float, default=0.1)
+    parser.add_argument('--gamma', type=float, default=0.99, help="Decay factor for decayed_lints")
+    parser.add_argument('--repeat', type=int, default=1, help="Replay the log this many times back to back")
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="Print results as JSON")
+    args = parser.parse_args(argv)
+
+    def events():
+        # Stream the log once per repeat instead of holding it in memory
+        for _ in range(max(args.repeat, 1)):
+            for event in iter_feedback(args.db, args.condition, args.chunk_size):
+                if event[1].shape[0] == args.n_features:
+                    yield event
+
+    results = [replay(events(), policy) for policy in build_policies(args)]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"Replayed {results[0]['events'] if results else 0} feedback events from {args.db}")
+    header = f"{'policy':<16}{'played':>8}{'reward':>10}{'per play':>10}{'regret':>10}{'mse':>10}{'updates/s':>12}"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['policy']:<16}{r['played']:>8}{r['cumulative_reward']:>10.2f}{r['reward_per_play']:>10.3f}"
+              f"{r['regret_proxy']:>10.2f}{r['mse']:>10.4f}{r['updates_per_second']:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""Persistent SQLite-backed cache for YouTube search results.
+
+Entries live in their own SQLite file (youtube_cache.db by default) so they
+survive restarts and deploys. Each entry is keyed by the canonical query
+and remembers how many results were requested; a request for more results
+than an entry holds is a miss, a request for fewer is served from it. An
+entry expires after a TTL and is evicted least-recently-used first once the total
+stored response size exceeds the byte budget. Expired entries stay servable
+as stale for ``stale_seconds`` so callers can answer immediately and
+refresh in the background.
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from search_query import canonical_query
+
+DEFAULT_CACHE_PATH = Path("youtube_cache.db")
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_STALE_SECONDS = 30 * 24 * 3600
+
+
+def normalize_query(query: str) -> str:
+    """Cache key for a search query"""
+    return canonical_query(query)
+
+
+def _covers(results: List[Dict], stored_max_results: Optional[int], max_results: Optional[int]) -> bool:
+    """Whether an entry fetched for stored_max_results answers a request for max_results"""
+    if max_results is None or len(results) >= max_results:
+        return True
+    # Fewer results than were asked for means the upstream had no more
+    return stored_max_results is not None and len(results) < stored_max_results
+
+
+class SearchCache:
+    """Disk-backed search result cache with TTLs, LRU eviction and counters"""
+
+    def __init__(self, path: str = str(DEFAULT_CACHE_PATH), ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 max_bytes: int = DEFAULT_MAX_BYTES, stale_seconds: float = DEFAULT_STALE_SECONDS):
+        self.path = Path(path)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.stale_seconds = stale_seconds
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS search_cache (
+                key TEXT PRIMARY KEY,
+                query TEXT,
+                max_results INTEGER,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        ''')
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(search_cache)')]
+        if 'max_results' not in columns:
+            # Cache files written before the request size was stored
+            self._conn.execute('ALTER TABLE search_cache ADD COLUMN max_results INTEGER')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS idx_search_cache_last_access ON search_cache (last_access)')
+        self._conn.commit()
+
+    def lookup(self, query: str, max_results: Optional[int] = None,
+               allow_stale: bool = True) -> Tuple[Optional[List[Dict]], bool]:
+        """Return (results, fresh) for query; results is None on a miss.
+
+        With max_results, an entry fetched for fewer results is a miss and a
+        larger one is cut down to max_results. Expired entries are returned
+        with fresh=False while they are less than stale_seconds past expiry
+        (if allow_stale) and deleted after that.
+        """
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response, expires_at, max_results FROM search_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, False
+            fresh = row[1] > now
+            if row[1] + self.stale_seconds <= now:
+                self._conn.execute('DELETE FROM search_cache WHERE key = ?', (key,))
+                self._conn.commit()
+                self.expirations += 1
+                self.misses += 1
+                return None, False
+            if not fresh and not allow_stale:
+                self.misses += 1
+                return None, False
+            results = json.loads(row[0])
+            if not _covers(results, row[2], max_results):
+                self.misses += 1
+                return None, False
+            self._conn.execute('UPDATE search_cache SET last_access = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            if fresh:
+                self.hits += 1
+            else:
+                self.stale_hits += 1
+        return results if max_results is None else results[:max_results], fresh
+
+    def get(self, query: str, max_results: Optional[int] = None) -> Optional[List[Dict]]:
+        """Return fresh cached results for query, or None on a miss or expired entry"""
+        results, _ = self.lookup(query, max_results, allow_stale=False)
+        return results
+
+    def contains(self, query: str, max_results: Optional[int] = None) -> bool:
+        """Whether a fresh entry covering max_results exists, without touching LRU order or counters"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT response, max_results FROM search_cache WHERE key = ? AND expires_at > ?',
+                (normalize_query(query), time.time())
+            ).fetchone()
+        return row is not None and _covers(json.loads(row[0]), row[1], max_results)
+
+    def set(self, query: str, results: List[Dict], ttl_seconds: Optional[float] = None,
+            max_results: Optional[int] = None):
+        """Store results fetched for max_results and evict old entries if over the byte budget"""
+        key = normalize_query(query)
+        if max_results is None:
+            max_results = len(results)
+        response = json.dumps(results)
+        size = len(response.encode('utf-8'))
+        now = time.time()
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._conn.execute('''
+                INSERT OR REPLACE INTO search_cache
+                    (key, query, max_results, response, size, created_at, expires_at, last_access)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (key, query, max_results, response, size, now, now + ttl, now))
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM search_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        cursor = self._conn.execute('SELECT key, size FROM search_cache ORDER BY last_access')
+        victims = []
+        for key, size in cursor:
+            if total <= self.max_bytes:
+                break
+            victims.append((key,))
+            total -= size
+        self._conn.executemany('DELETE FROM search_cache WHERE key = ?', victims)
+        self.evictions += len(victims)
+
+    def purge_expired(self) -> int:
+        """Delete every entry past its stale window; returns how many were removed"""
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM search_cache WHERE expires_at <= ?',
+                                        (time.time() - self.stale_seconds,))
+            self._conn.commit()
+            self.expirations += cursor.rowcount
+            return cursor.rowcount
+
+    def clear(self):
+        """Remove every cached entry"""
+        with self._lock:
+            self._conn.execute('DELETE FROM search_cache')
+            self._conn.commit()
+
+    def stats(self) -> Dict:
+        """Entry count, stored bytes and hit/miss/eviction counters"""
+        with self._lock:
+            entries, size = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM search_cache'
+            ).fetchone()
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            'cache_size': entries,
+            'cache_bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'hit_rate': (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+            'expirations': self.expirations,
+            'evictions': self.evictions,
+            'path': str(self.path),
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,330 @@
+"""Record and replay YouTube search proxy traffic.
+
+RecordingAdapter is a requests transport adapter that passes requests
+through to the real proxy and saves every request/response pair, with its
+measured latency, as a JSON fixture. ReplayAdapter serves those fixtures
+without any network access, replaying the recorded latency (or a fixed
+one) and optionally injecting HTTP errors and timeouts.
+
+Set YOUTUBE_SEARCH_RECORD_DIR or YOUTUBE_SEARCH_REPLAY_DIR and the shared
+search session (youtube_search.get_shared_session) uses the matching
+adapter, so the whole recommendation path can be recorded or replayed
+unchanged. In-process replay takes its latency and faults from
+YOUTUBE_SEARCH_REPLAY_LATENCY, _LATENCY_SCALE, _ERROR_RATE, _ERROR_STATUS,
+_TIMEOUT_RATE and _SEED (see ReplayPlan.from_env). To exercise the real HTTP stack, retries included, serve the
+fixtures over HTTP and point API_BASE_URL at them::
+
+    python search_fixtures.py record --fixtures fixtures/youtube --db theramuse.db
+    python search_fixtures.py serve --fixtures fixtures/youtube --port 8765 --error-rate 0.05
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import select
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from search_query import canonical_query
+
+RECORD_DIR_ENV = "YOUTUBE_SEARCH_RECORD_DIR"
+REPLAY_DIR_ENV = "YOUTUBE_SEARCH_REPLAY_DIR"
+REPLAY_PLAN_ENV_PREFIX = "YOUTUBE_SEARCH_REPLAY_"
+DEFAULT_MAX_RESULTS = 5
+# How long the server holds an unanswered request open; longer than any
+# read timeout the search client uses
+DEFAULT_HANG = 60.0
+
+
+def fixture_key(query: str, max_results) -> str:
+    """File name stem of the fixture for a query"""
+    text = f"{canonical_query(query)}\n{max_results}"
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _request_params(url: str) -> Tuple[str, str]:
+    params = parse_qs(urlparse(url).query)
+    return params.get('q', [''])[0], params.get('max_results', [str(DEFAULT_MAX_RESULTS)])[0]
+
+
+class FixtureStore:
+    """Directory of <key>.json fixtures: query, max_results, status, body, elapsed"""
+
+    def __init__(self, fixture_dir: str):
+        self.path = Path(fixture_dir)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def save(self, query: str, max_results, status: int, body: str, elapsed: float):
+        fixture = {
+            'query': query,
+            'max_results': int(max_results),
+            'status': status,
+            'body': body,
+            'elapsed': elapsed,
+            'recorded_at': time.time(),
+        }
+        target = self.path / f"{fixture_key(query, max_results)}.json"
+        fd, tmp_path = tempfile.mkstemp(dir=str(self.path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(fixture, f, ensure_ascii=False)
+        os.replace(tmp_path, target)
+
+    def load(self, query: str, max_results) -> Optional[Dict]:
+        target = self.path / f"{fixture_key(query, max_results)}.json"
+        try:
+            with open(target, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self.path.glob('*.json'))
+
+
+class ReplayPlan:
+    """Latency and fault injection settings shared by the adapter and the server"""
+
+    def __init__(self, latency: Optional[float] = None, latency_scale: float = 1.0, error_rate: float = 0.0,
+                 error_status: int = 503, timeout_rate: float = 0.0, seed: Optional[int] = None,
+                 hang: float = DEFAULT_HANG):
+        # latency None replays each fixture's recorded latency (times latency_scale)
+        self.latency = latency
+        self.latency_scale = latency_scale
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, environ=None) -> "ReplayPlan":
+        """Plan from YOUTUBE_SEARCH_REPLAY_{LATENCY,LATENCY_SCALE,ERROR_RATE,ERROR_STATUS,TIMEOUT_RATE,SEED}"""
+        environ = os.environ if environ is None else environ
+
+        def setting(name, kind, default):
+            value = environ.get(REPLAY_PLAN_ENV_PREFIX + name)
+            if value in (None, ''):
+                return default
+            try:
+                return kind(value)
+            except ValueError:
+                raise ValueError(f"{REPLAY_PLAN_ENV_PREFIX + name} must be a {kind.__name__}, got {value!r}")
+
+        return cls(latency=setting('LATENCY', float, None),
+                   latency_scale=setting('LATENCY_SCALE', float, 1.0),
+                   error_rate=setting('ERROR_RATE', float, 0.0),
+                   error_status=setting('ERROR_STATUS', int, 503),
+                   timeout_rate=setting('TIMEOUT_RATE', float, 0.0),
+                   seed=setting('SEED', int, None))
+
+    def delay_for(self, fixture: Optional[Dict]) -> float:
+        if self.latency is not None:
+            return self.latency
+        return (fixture or {}).get('elapsed', 0.0) * self.latency_scale
+
+    def fault(self) -> Optional[str]:
+        """'timeout', 'error' or None for the next request"""
+        with self._lock:
+            roll = self._rng.random()
+        if roll < self.timeout_rate:
+            return 'timeout'
+        if roll < self.timeout_rate + self.error_rate:
+            return 'error'
+        return None
+
+
+class RecordingAdapter(BaseAdapter):
+    """Pass requests through to the proxy and save each response as a fixture"""
+
+    def __init__(self, fixture_dir: str, adapter: Optional[BaseAdapter] = None):
+        super().__init__()
+        self.store = FixtureStore(fixture_dir)
+        self.adapter = adapter if adapter is not None else HTTPAdapter()
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        response = self.adapter.send(request, **kwargs)
+        elapsed = time.perf_counter() - start
+        query, max_results = _request_params(request.url)
+        self.store.save(query, max_results, response.status_code, response.text, elapsed)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """Serve recorded fixtures in place of the proxy; unknown queries get 404"""
+
+    def __init__(self, fixture_dir: str, plan: Optional[ReplayPlan] = None):
+        super().__init__()
+        self.store = FixtureStore(fixture_dir)
+        self.plan = plan if plan is not None else ReplayPlan()
+
+    def send(self, request, timeout=None, **kwargs):
+        query, max_results = _request_params(request.url)
+        fixture = self.store.load(query, max_results)
+        delay = self.plan.delay_for(fixture)
+        fault = self.plan.fault()
+
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        if fault == 'timeout' or (read_timeout is not None and delay > read_timeout):
+            time.sleep(read_timeout if read_timeout is not None else delay)
+            raise requests.exceptions.ReadTimeout(f"Replayed timeout for '{query}'", request=request)
+        time.sleep(delay)
+
+        if fault == 'error':
+            status, body = self.plan.error_status, '{}'
+        elif fixture is None:
+            status, body = 404, json.dumps({'error': f"No fixture for '{query}'"})
+        else:
+            status, body = fixture['status'], fixture['body']
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = body.encode('utf-8')
+        response.encoding = 'utf-8'
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        response.url = request.url
+        response.request = request
+        response.reason = 'Replayed'
+        return response
+
+    def close(self):
+        pass
+
+
+def mount_fixture_adapter(session: requests.Session) -> requests.Session:
+    """Mount a recording or replay adapter on session if the environment asks for one"""
+    if os.environ.get(REPLAY_DIR_ENV):
+        adapter = ReplayAdapter(os.environ[REPLAY_DIR_ENV], ReplayPlan.from_env())
+    elif os.environ.get(RECORD_DIR_ENV):
+        adapter = RecordingAdapter(os.environ[RECORD_DIR_ENV], session.get_adapter('https://'))
+    else:
+        return session
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def make_handler(store: FixtureStore, plan: ReplayPlan):
+    """HTTP handler class answering proxy-style GET ?q=...&max_results=... from fixtures"""
+
+    class ReplayHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            query, max_results = _request_params(self.path)
+            fixture = store.load(query, max_results)
+            fault = plan.fault()
+
+            if fault == 'timeout':
+                # Leave the request unanswered until the client gives up (closes
+                # the socket, which makes it readable) or plan.hang runs out, so
+                # the client sees a read timeout rather than a dropped connection
+                self.close_connection = True
+                select.select([self.connection], [], [], plan.hang)
+                return
+            time.sleep(plan.delay_for(fixture))
+            if fault == 'error':
+                status, body = plan.error_status, '{}'
+            elif fixture is None:
+                status, body = 404, json.dumps({'error': f"No fixture for '{query}'"})
+            else:
+                status, body = fixture['status'], fixture['body']
+
+            payload = body.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return ReplayHandler
+
+
+def record_history(fixture_dir: str, db_path: str, limit: Optional[int], max_results: int) -> int:
+    """Record fixtures for the queries found in the session history"""
+    from cache_warmup import iter_session_queries, rank_queries
+    from youtube_search import create_http_session, load_api_base_url
+
+    api_base_url = load_api_base_url()
+    if not api_base_url:
+        raise RuntimeError("API_BASE_URL is not configured")
+    session = create_http_session()
+    adapter = RecordingAdapter(fixture_dir, session.get_adapter('https://'))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    ranked = rank_queries([query for _, query in iter_session_queries(db_path)])
+    recorded = 0
+    for query, _ in ranked[:limit]:
+        try:
+            session.get(api_base_url, params={'q': query, 'max_results': max_results}, timeout=(3.05, 30))
+            recorded += 1
+        except requests.RequestException as e:
+            print(f"Failed to record '{query}': {str(e)}")
+    return recorded
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record or replay YouTube search proxy fixtures")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    record = sub.add_parser('record', help="Record fixtures for the queries in the session history")
+    record.add_argument('--fixtures', required=True, help="Fixture directory")
+    record.add_argument('--db', default="theramuse.db")
+    record.add_argument('--limit', type=int, help="Only record the N most frequent queries")
+    record.add_argument('--max-results', type=int, default=DEFAULT_MAX_RESULTS)
+
+    serve = sub.add_parser('serve', help="Serve fixtures over HTTP as a stand-in proxy")
+    serve.add_argument('--fixtures', required=True, help="Fixture directory")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--latency', type=float, help="Fixed latency in seconds (default: recorded latency)")
+    serve.add_argument('--latency-scale', type=float, default=1.0, help="Multiplier for recorded latency")
+    serve.add_argument('--error-rate', type=float, default=0.0, help="Fraction of requests answered with an error")
+    serve.add_argument('--error-status', type=int, default=503)
+    serve.add_argument('--timeout-rate', type=float, default=0.0, help="Fraction of requests left unanswered")
+    serve.add_argument('--seed', type=int)
+    serve.add_argument('--hang', type=float, default=DEFAULT_HANG,
+                       help="Seconds an unanswered request is held open")
+    args = parser.parse_args(argv)
+
+    if args.command == 'record':
+        recorded = record_history(args.fixtures, args.db, args.limit, args.max_results)
+        print(f"Recorded {recorded} fixtures into {args.fixtures}")
+        return 0
+
+    store = FixtureStore(args.fixtures)
+    plan = ReplayPlan(args.latency, args.latency_scale, args.error_rate, args.error_status,
+                      args.timeout_rate, args.seed, args.hang)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(store, plan))
+    print(f"Replaying {len(store)} fixtures on http://{args.host}:{server.server_port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
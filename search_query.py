@@ -0,0 +1,95 @@
+"""Canonical form of YouTube search queries.
+
+The condition modules build queries such as " 1983-2003 Bangladesh song",
+"1990-2010 dhaka song" or " Jazz, Rock, Pop music" from free-text intake
+fields. ``canonical_query`` maps semantically equal variants to one string
+before any cache lookup or network call:
+
+  - Unicode NFKC, case folding and whitespace collapsing
+  - trailing punctuation removed ("Disco song." -> "disco song")
+  - legacy spellings of places unified ("Dacca" -> "dhaka"), only for the
+    birthplace categories: elsewhere a place name may be part of a musician's
+    name ("Bombay Jayashri") and must reach the search proxy unchanged
+  - comma-joined genre lists sorted ("Rock, Jazz" -> "jazz, rock")
+"""
+
+import re
+import unicodedata
+from typing import Optional
+
+# Old or transliterated place names -> the spelling used in queries
+PLACE_ALIASES = {
+    'dacca': 'dhaka',
+    'chittagong': 'chattogram',
+    'chattagram': 'chattogram',
+    'comilla': 'cumilla',
+    'jessore': 'jashore',
+    'barisal': 'barishal',
+    'bogra': 'bogura',
+    'calcutta': 'kolkata',
+    'bombay': 'mumbai',
+    'madras': 'chennai',
+    'bangalore': 'bengaluru',
+    'bangla desh': 'bangladesh',
+}
+# Recommendation categories whose queries are built from a place name
+PLACE_CATEGORIES = frozenset({'birthplace_city', 'birthplace_country'})
+
+# Genres offered on the intake form, longest first so "classical fusion"
+# wins over "classical"
+GENRES = tuple(sorted((
+    'classical', 'jazz', 'rock', 'pop', 'r&b', 'hip-hop', 'country', 'folk',
+    'electronic', 'metal', 'indie', 'blues', 'reggae', 'classical fusion', 'bengali folk',
+), key=len, reverse=True))
+
+_PLACE_PATTERN = re.compile(
+    r'\b(' + '|'.join(re.escape(name) for name in sorted(PLACE_ALIASES, key=len, reverse=True)) + r')\b'
+)
+
+
+def _split_genre(item: str, at_end: bool):
+    """Split a known genre off the end (or start) of item; returns (rest, genre) or None"""
+    for genre in GENRES:
+        if item == genre:
+            return '', genre
+        if at_end and item.endswith(' ' + genre):
+            return item[:-len(genre)].rstrip(), genre
+        if not at_end and item.startswith(genre + ' '):
+            return item[len(genre):].lstrip(), genre
+    return None
+
+
+def _sort_genre_list(query: str) -> str:
+    """Order the items of a comma-joined genre list, keeping any prefix and suffix"""
+    items = [item.strip() for item in query.split(',')]
+    if len(items) < 2 or not all(items):
+        return query
+
+    first = _split_genre(items[0], at_end=True)
+    last = _split_genre(items[-1], at_end=False)
+    if first is None or last is None:
+        return query
+    prefix, items[0] = first
+    suffix, items[-1] = last
+
+    joined = ', '.join(sorted(items))
+    return ' '.join(part for part in (prefix, joined, suffix) if part)
+
+
+def canonical_query(query: str, category: Optional[str] = None) -> str:
+    """Canonical form of a search query; equal for semantically equal queries.
+
+    Place aliases are only applied when category is one of PLACE_CATEGORIES.
+    """
+    text = unicodedata.normalize('NFKC', query or '').casefold()
+    text = re.sub(r'\s+', ' ', text).strip()
+    text = re.sub(r'\s*,\s*', ', ', text)
+    text = text.rstrip(' .;:!')
+    if category in PLACE_CATEGORIES:
+        text = _PLACE_PATTERN.sub(lambda m: PLACE_ALIASES[m.group(1)], text)
+    return _sort_genre_list(text)
+
+
+def build_query(*parts: str, category: Optional[str] = None) -> str:
+    """Join query parts (e.g. nostalgia window, place, "song") into a canonical query"""
+    return canonical_query(' '.join(str(part) for part in parts if part), category)
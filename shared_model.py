@@ -0,0 +1,159 @@
+"""Process-wide TheraMuse model shared by every browser session.
+
+app.py wraps its single TheraMuse backend in a SharedTheraMuse, which
+decides what each entry point has to lock. Feedback writes are
+serialised; recommendation reads take no lock when the backend's bandits
+are bandit.LinearThompsonSampling (see _adopt_bandits), and otherwise
+share a ReadWriteLock with the writes. Nothing here imports Streamlit or
+the backend, so the locking can be tested with a stand-in model.
+"""
+
+import threading
+from contextlib import contextmanager, nullcontext
+from typing import List, Tuple
+
+import bandit
+
+
+class ReadWriteLock:
+    """Any number of concurrent readers or one writer.
+
+    Waiting writers block new readers so a writer is not starved by a
+    steady stream of recommendation requests.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+def _public_methods(cls) -> set:
+    return {name for name in dir(cls) if not name.startswith('_') and callable(getattr(cls, name, None))}
+
+
+def _adopt_bandits(model) -> bool:
+    """Replace the model's pickled bandits with bandit.LinearThompsonSampling (same state layout).
+
+    A bandit is only swapped when bandit.LinearThompsonSampling has every
+    public method of its class, so the backend's calls still resolve;
+    otherwise the original object is kept. Returns True when every bandit
+    is a bandit.LinearThompsonSampling afterwards.
+    """
+    bandits = getattr(model, 'bandits', None)
+    if not isinstance(bandits, dict):
+        return False
+    adopted = True
+    for condition, old in list(bandits.items()):
+        if isinstance(old, bandit.LinearThompsonSampling):
+            continue
+        missing = _public_methods(type(old)) - _public_methods(bandit.LinearThompsonSampling)
+        if missing or not all(hasattr(old, name) for name in ('B', 'mu', 'f')):
+            print(f"Keeping the backend's {type(old).__name__} for {condition}; "
+                  f"bandit.LinearThompsonSampling lacks {sorted(missing) or 'its B/mu/f state'}")
+            adopted = False
+            continue
+        bandits[condition] = bandit.LinearThompsonSampling.from_state(vars(old))
+    return adopted
+
+
+class SharedTheraMuse:
+    """Lock-aware front for one TheraMuse model.
+
+    Feedback writes are serialised by one lock. When every bandit could be
+    adopted as a bandit.LinearThompsonSampling, which samples and scores
+    from an immutable posterior snapshot that each update swaps in,
+    recommendation reads take no bandit lock, so an intake waiting on
+    YouTube never holds anything a feedback write needs, and the reverse.
+    Otherwise reads and feedback writes share a readers-writer lock.
+
+    The YouTube search cache is not locked here: clearing it is a single
+    atomic step in the cache itself (SearchCache.clear is one DELETE
+    transaction), so a concurrent search sees the cache either before or
+    after the clear. Only concurrent clears are serialised, so a clear never
+    waits for an intake's network calls and an intake never waits for a
+    clear. Only the methods below are exposed.
+    """
+
+    def __init__(self, model):
+        self._model = model
+        self._write_lock = threading.Lock()
+        self._clear_lock = threading.Lock()
+        # None when the bandits publish snapshots and reads need no lock
+        self._bandit_lock = None if _adopt_bandits(self._model) else ReadWriteLock()
+
+    def _reading_bandits(self):
+        return self._bandit_lock.read() if self._bandit_lock else nullcontext()
+
+    def _updating_bandits(self):
+        return self._bandit_lock.write() if self._bandit_lock else nullcontext()
+
+    # Readers
+    def get_therapy_recommendations(self, *args, **kwargs):
+        with self._reading_bandits():
+            return self._model.get_therapy_recommendations(*args, **kwargs)
+
+    def get_analytics(self, *args, **kwargs):
+        with self._reading_bandits():
+            return self._model.get_analytics(*args, **kwargs)
+
+    def check_api_health(self, *args, **kwargs):
+        return self._model.check_api_health(*args, **kwargs)
+
+    def get_youtube_cache_status(self, *args, **kwargs):
+        return self._model.get_youtube_cache_status(*args, **kwargs)
+
+    # Writers
+    def record_feedback(self, *args, **kwargs):
+        with self._write_lock, self._updating_bandits():
+            return self._model.record_feedback(*args, **kwargs)
+
+    def clear_youtube_cache(self, *args, **kwargs):
+        with self._clear_lock:
+            return self._model.clear_youtube_cache(*args, **kwargs)
+
+    def record_feedback_batch(self, events: List[Tuple]) -> List[Tuple[Tuple, str]]:
+        """Apply several record_feedback argument tuples under one lock acquisition.
+
+        Returns (event, error message) for every event that failed; one bad
+        event does not prevent the rest of the batch from being recorded.
+        """
+        failures = []
+        with self._write_lock, self._updating_bandits():
+            for args in events:
+                try:
+                    self._model.record_feedback(*args)
+                except Exception as e:
+                    failures.append((args, str(e)))
+                    print(f"Failed to record feedback for patient {args[0]}: {str(e)}")
+        return failures
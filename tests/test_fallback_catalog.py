@@ -0,0 +1,55 @@
+import json
+import sqlite3
+
+from fallback_catalog import FallbackCatalog
+
+
+def make_db(path):
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE therapy_sessions (session_id TEXT PRIMARY KEY, session_data TEXT);
+        CREATE TABLE therapy_recommendations (query TEXT, song_title TEXT, video_id TEXT, channel TEXT);
+    ''')
+    session = {'categories': {
+        'genre': {'query': ['Jazz music'], 'songs': [
+            {'title': 'Take Five', 'url': 'https://www.youtube.com/watch?v=vmDDOFXSgAs'},
+            {'title': 'So What', 'url': 'https://youtu.be/zqNTltOGh5c'},
+        ]},
+        'musician': {'query': 'Lata Mangeshkar songs', 'songs': [
+            {'title': 'Lag Jaa Gale', 'url': 'https://www.youtube.com/watch?v=AbCdEfGhIjK'},
+            # The same video found again must not be listed twice
+            {'title': 'Take Five', 'url': 'https://www.youtube.com/watch?v=vmDDOFXSgAs'},
+        ]},
+        'broken': 'not a category',
+    }}
+    conn.executemany('INSERT INTO therapy_sessions VALUES (?, ?)',
+                     [('s1', json.dumps(session)), ('s2', 'not json'), ('s3', None)])
+    conn.execute('INSERT INTO therapy_recommendations VALUES (?, ?, ?, ?)',
+                 ('Rain sounds for sleep', 'Gentle Rain', 'RaInSoUnDs1', 'Nature'))
+    conn.commit()
+    conn.close()
+
+
+def test_catalog_searches_recommended_songs_by_word_overlap(tmp_path):
+    db_path = tmp_path / "theramuse.db"
+    make_db(db_path)
+    catalog = FallbackCatalog(str(db_path))
+
+    assert len(catalog) == 4
+    results = catalog.search('relaxing jazz songs', 5)
+    assert [song['title'] for song in results] == ['Take Five', 'So What']
+    assert results[0] == {'title': 'Take Five', 'url': 'https://www.youtube.com/watch?v=vmDDOFXSgAs',
+                          'video_id': 'vmDDOFXSgAs', 'channel': None, 'source': 'fallback'}
+    assert catalog.search('JAZZ', 1)[0]['title'] == 'Take Five'
+
+    rain = catalog.search('rain', 5)
+    assert rain == [{'title': 'Gentle Rain', 'url': 'https://www.youtube.com/watch?v=RaInSoUnDs1',
+                     'video_id': 'RaInSoUnDs1', 'channel': 'Nature', 'source': 'fallback'}]
+    assert catalog.search('music songs', 5) == []
+
+
+def test_missing_database_gives_an_empty_catalog(tmp_path):
+    db_path = tmp_path / "missing.db"
+    catalog = FallbackCatalog(str(db_path))
+    assert catalog.search('jazz') == []
+    assert not db_path.exists()
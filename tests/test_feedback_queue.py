@@ -0,0 +1,42 @@
+import threading
+
+from feedback_queue import QUEUE_FULL_ERROR, FeedbackQueue
+
+
+class StalledModel:
+    """record_feedback_batch blocks until released, like a stalled database write"""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.recorded = []
+
+    def record_feedback_batch(self, events):
+        self.started.set()
+        self.release.wait(5)
+        self.recorded.extend(events)
+        return []
+
+
+def _event(i):
+    return (f'p{i}', 's1', 'adhd', {'title': f'song {i}'}, 'like', {})
+
+
+def test_full_queue_rejects_and_reports():
+    model = StalledModel()
+    feedback = FeedbackQueue(model, maxsize=2, batch_size=1)
+    assert feedback.submit(*_event(0))
+    # The worker now holds event 0, so the queue has room for exactly two more
+    assert model.started.wait(5)
+    assert feedback.submit(*_event(1))
+    assert feedback.submit(*_event(2))
+    assert not feedback.submit(*_event(3))
+    assert feedback.pending() == 2
+    assert feedback.rejected == 1
+    assert feedback.recent_failures[-1]['patient_id'] == 'p3'
+    assert feedback.recent_failures[-1]['error'] == QUEUE_FULL_ERROR
+
+    model.release.set()
+    feedback.close(timeout=5)
+    assert [event[0] for event in model.recorded] == ['p0', 'p1', 'p2']
+    assert feedback.processed == 3
@@ -0,0 +1,173 @@
+import sqlite3
+
+import pytest
+
+from migrations import LATEST_VERSION, PATIENT_PAGE_SQL, check_query_plans, migrate, schema_version
+
+# Schema written by app versions before the migration runner: patients keyed
+# by id and foreign keys naming the old key columns
+LEGACY_SCHEMA = '''
+    CREATE TABLE patients (
+        id TEXT PRIMARY KEY,
+        name TEXT,
+        age INTEGER,
+        condition TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE therapy_sessions (
+        id TEXT PRIMARY KEY,
+        patient_id TEXT,
+        session_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        recommendations_count INTEGER,
+        session_data TEXT,
+        FOREIGN KEY (patient_id) REFERENCES patients (id)
+    );
+    CREATE TABLE therapy_recommendations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        session_id TEXT NOT NULL,
+        patient_id TEXT NOT NULL,
+        category TEXT NOT NULL,
+        query TEXT,
+        song_title TEXT,
+        video_id TEXT,
+        channel TEXT,
+        description TEXT,
+        rank INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (session_id) REFERENCES therapy_sessions(session_id)
+    );
+    INSERT INTO patients (id, name, age, condition) VALUES ('p1', 'Zoë', 72, 'dementia');
+    INSERT INTO therapy_sessions (id, patient_id, recommendations_count) VALUES ('s1', 'p1', 3);
+    INSERT INTO therapy_recommendations (session_id, patient_id, category, rank) VALUES ('s1', 'p1', 'seasonal', 1);
+'''
+
+
+# Patients table from before created_at existed, next to rows whose date is NULL
+UNDATED_SCHEMA = '''
+    CREATE TABLE patients (
+        patient_id TEXT PRIMARY KEY,
+        name TEXT,
+        condition TEXT
+    );
+    CREATE TABLE therapy_sessions (
+        id TEXT PRIMARY KEY,
+        patient_id TEXT,
+        session_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        recommendations_count INTEGER,
+        session_data TEXT
+    );
+    INSERT INTO patients (patient_id, name, condition) VALUES
+        ('p1', 'Ann', 'adhd'), ('p2', 'Ben', 'adhd'), ('p3', 'Cai', 'dementia'),
+        ('p4', 'Dee', 'adhd'), ('p5', 'Eli', 'dementia');
+    INSERT INTO therapy_sessions (id, patient_id, session_date) VALUES ('s1', 'p2', '2025-01-02 10:00:00');
+'''
+
+
+@pytest.fixture
+def fresh_db(tmp_path):
+    return tmp_path / "fresh.db"
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    path = tmp_path / "legacy.db"
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.close()
+    return path
+
+
+@pytest.mark.parametrize('db', ['fresh_db', 'legacy_db'])
+def test_migrated_database_has_no_full_scans(db, request):
+    path = request.getfixturevalue(db)
+    migrate(path)
+    conn = sqlite3.connect(path)
+    try:
+        assert schema_version(conn) == LATEST_VERSION
+        assert check_query_plans(conn) == []
+    finally:
+        conn.close()
+
+
+def test_migrate_is_idempotent(legacy_db):
+    assert migrate(legacy_db) == LATEST_VERSION
+    assert migrate(legacy_db) == 0
+
+
+def test_legacy_rows_move_to_canonical_keys(legacy_db):
+    migrate(legacy_db)
+    conn = sqlite3.connect(legacy_db)
+    try:
+        assert conn.execute('SELECT patient_id, name FROM patients').fetchall() == [('p1', 'Zoë')]
+        foreign_keys = {
+            (table, row[2], row[4])
+            for table in ('therapy_sessions', 'therapy_recommendations')
+            for row in conn.execute(f'PRAGMA foreign_key_list({table})')
+        }
+        assert foreign_keys == {
+            ('therapy_sessions', 'patients', 'patient_id'),
+            ('therapy_recommendations', 'therapy_sessions', 'id'),
+        }
+        assert conn.execute('PRAGMA foreign_key_check').fetchall() == []
+    finally:
+        conn.close()
+
+
+def test_plan_check_ignores_small_table_statistics(legacy_db):
+    migrate(legacy_db)
+    conn = sqlite3.connect(legacy_db)
+    try:
+        # ANALYZE ran on a one-row database, yet the check still sees the indexes
+        assert conn.execute('SELECT COUNT(*) FROM sqlite_stat1').fetchone()[0] > 0
+        assert check_query_plans(conn) == []
+        conn.execute('DROP INDEX idx_therapy_feedback_patient_created_desc')
+        assert any(problem.startswith('page feedback:') for problem in check_query_plans(conn))
+    finally:
+        conn.close()
+
+
+def test_plan_check_only_accepts_the_known_linear_plans(legacy_db):
+    migrate(legacy_db)
+    conn = sqlite3.connect(legacy_db)
+    try:
+        # The count sort's temp sort is accepted, a scan of the whole sessions table is not
+        conn.execute('DROP INDEX idx_therapy_sessions_patient_date_desc')
+        problems = check_query_plans(conn)
+        assert 'patients page by sessions: SCAN therapy_sessions' in problems
+        assert 'patients page by sessions: USE TEMP B-TREE FOR ORDER BY' not in problems
+    finally:
+        conn.close()
+
+
+def _page_through(conn, direction, page_size=2):
+    """Patient ids in the order the patient list pages them by registration date"""
+    seen, after = [], None
+    while True:
+        keyset = '' if after is None else f"WHERE (p.created_at, p.patient_id) {'<' if direction == 'DESC' else '>'} (?, ?)"
+        rows = conn.execute(PATIENT_PAGE_SQL.format(
+            key_list='p.created_at, p.patient_id', joins='', where='', keyset=keyset,
+            order=f'p.created_at {direction}, p.patient_id {direction}'), (*(after or ()), page_size)).fetchall()
+        if not rows:
+            return seen
+        seen.extend(row[0] for row in rows)
+        after = rows[-1][1:]
+
+
+@pytest.mark.parametrize('direction', ['DESC', 'ASC'])
+def test_undated_patients_are_backfilled_and_paged(tmp_path, direction):
+    path = tmp_path / "undated.db"
+    conn = sqlite3.connect(path)
+    conn.executescript(UNDATED_SCHEMA)
+    conn.close()
+    migrate(path)
+    conn = sqlite3.connect(path)
+    try:
+        assert conn.execute("SELECT created_at FROM patients WHERE patient_id = 'p2'").fetchone() == \
+            ('2025-01-02 10:00:00',)
+        seen = _page_through(conn, direction)
+        assert sorted(seen) == ['p1', 'p2', 'p3', 'p4', 'p5']
+        assert len(seen) == conn.execute('SELECT COUNT(*) FROM patients').fetchone()[0]
+        with pytest.raises(sqlite3.IntegrityError):
+            conn.execute("INSERT INTO patients (patient_id, created_at) VALUES ('p6', NULL)")
+    finally:
+        conn.close()
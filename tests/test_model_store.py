@@ -0,0 +1,224 @@
+import io
+import json
+import pickle
+import sqlite3
+import sys
+import types
+
+import numpy as np
+import pytest
+
+import model_store
+from bandit import LinearThompsonSampling, merge_spooled_deltas, save_deltas
+from migrations import migrate
+from model_store import load_bandits, load_model, merge_spool, save_model
+
+
+def spool_one_worker(spool_dir, n_events, seed):
+    rng = np.random.default_rng(seed)
+    worker = {'adhd': LinearThompsonSampling(4)}
+    for _ in range(n_events):
+        worker['adhd'].update(rng.normal(size=4), rng.normal())
+    return save_deltas({c: b.take_delta() for c, b in worker.items()}, str(spool_dir))
+
+
+def test_crash_between_save_and_delete_does_not_double_count(tmp_path, monkeypatch):
+    path = tmp_path / "model.bin"
+    spool = tmp_path / "spool"
+    save_model(path, {'adhd': LinearThompsonSampling(4)}, exploration_rate=0.1)
+    first = spool_one_worker(spool, 5, seed=0)
+
+    def crash(paths):
+        raise KeyboardInterrupt
+    monkeypatch.setattr(model_store, 'remove_spool_files', crash)
+    with pytest.raises(KeyboardInterrupt):
+        merge_spool(path, spool)
+    monkeypatch.undo()
+
+    assert first.exists()
+    assert load_model(path)['merged_spool'] == [first.name]
+    B_after_crash = np.array(load_bandits(path)['adhd'].B)
+
+    second = spool_one_worker(spool, 3, seed=1)
+    assert merge_spool(path, spool) == 3
+    assert not first.exists() and not second.exists()
+
+    model = load_model(path)
+    assert model['bandits']['adhd']['n_interactions'] == 8
+    assert model['exploration_rate'] == 0.1
+    assert model['merged_spool'] == [first.name, second.name]
+    assert not np.allclose(np.array(model['bandits']['adhd']['B']), B_after_crash)
+
+    # Nothing left to merge: the model is unchanged
+    assert merge_spool(path, spool) == 0
+    assert load_model(path)['bandits']['adhd']['n_interactions'] == 8
+
+
+def test_merge_creates_bandits_for_new_conditions(tmp_path):
+    path = tmp_path / "model.bin"
+    spool = tmp_path / "spool"
+    save_model(path, {'adhd': LinearThompsonSampling(4)}, exploration_rate=0.1)
+    rng = np.random.default_rng(2)
+    worker = {'dementia': LinearThompsonSampling(4)}
+    for _ in range(4):
+        worker['dementia'].update(rng.normal(size=4), rng.normal())
+    spooled = save_deltas({c: b.take_delta() for c, b in worker.items()}, str(spool))
+
+    bandits = load_bandits(path)
+    assert merge_spooled_deltas(bandits, str(spool)) == (4, [spooled], ['dementia'])
+    assert merge_spooled_deltas(bandits, str(spool), [spooled.name]) == (0, [spooled], [])
+
+    assert merge_spool(path, spool) == 4
+    assert not spooled.exists()
+    bandits = load_bandits(path)
+    assert bandits['dementia'].n_interactions == 4
+    np.testing.assert_allclose(bandits['dementia'].mu, worker['dementia'].mu)
+
+
+def test_rebuilt_model_loads_in_the_backend(tmp_path, monkeypatch):
+    db = tmp_path / "theramuse.db"
+    migrate(db)
+    rng = np.random.default_rng(0)
+    conn = sqlite3.connect(db)
+    conn.executemany(
+        "INSERT INTO therapy_feedback (patient_id, condition, reward, context_features) VALUES (?, ?, ?, ?)",
+        [('p1', 'adhd', float(rng.normal()), json.dumps(rng.random(20).tolist())) for _ in range(30)])
+    conn.commit()
+    conn.close()
+
+    legacy = tmp_path / "theramuse_model.pkl"
+    model_store.main(['rebuild', '--db', str(db), '--out', str(tmp_path / "model.bin"),
+                      '--legacy-out', str(legacy)])
+
+    # The backend unpickles with its own main.LinearThompsonSampling class
+    backend = types.ModuleType('main')
+    backend.LinearThompsonSampling = type('LinearThompsonSampling', (), {})
+    monkeypatch.setitem(sys.modules, 'main', backend)
+    with open(legacy, 'rb') as fh:
+        loaded = pickle.load(fh)
+
+    adhd = loaded['bandits']['adhd']
+    assert isinstance(adhd, backend.LinearThompsonSampling)
+    assert sorted(vars(adhd)) == sorted(model_store.LEGACY_BANDIT_KEYS)
+    assert adhd.n_interactions == 30
+    assert loaded['exploration_rate'] == model_store.DEFAULT_EXPLORATION_RATE
+    expected = load_bandits(tmp_path / "model.bin")['adhd']
+    np.testing.assert_allclose(adhd.B, expected.B)
+    # SharedTheraMuse adopts the backend's bandits from their attributes
+    np.testing.assert_allclose(LinearThompsonSampling.from_state(vars(adhd)).mu, expected.mu)
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = tmp_path / "model.bin"
+    rng = np.random.default_rng(3)
+    bandits = {'adhd': LinearThompsonSampling(5, alpha=0.5, lambda_reg=2.0, decay=0.99),
+               'dementia': LinearThompsonSampling(3)}
+    for _ in range(7):
+        bandits['adhd'].update(rng.normal(size=5), rng.normal())
+    save_model(path, bandits, exploration_rate=0.2, saved_at='2025-10-14T02:29:01',
+               merged_spool=['delta_2.npz', 'delta_1.npz'])
+
+    header = model_store.read_header(path)
+    assert header['format'] == 'theramuse-model'
+    assert header['version'] == model_store.FORMAT_VERSION
+    assert header['saved_at'] == '2025-10-14T02:29:01'
+    assert header['exploration_rate'] == 0.2
+    assert header['merged_spool'] == ['delta_1.npz', 'delta_2.npz']
+    adhd = header['bandits']['adhd']
+    assert (adhd['n_features'], adhd['alpha'], adhd['lambda_reg'], adhd['decay']) == (5, 0.5, 2.0, 0.99)
+    assert adhd['n_interactions'] == 7
+    assert adhd['arrays']['B']['shape'] == [5, 5]
+    offsets = [spec['offset'] for entry in header['bandits'].values() for spec in entry['arrays'].values()]
+    assert all(offset % model_store.ALIGNMENT == 0 for offset in offsets)
+
+    model = load_model(path)
+    assert model['exploration_rate'] == 0.2
+    for condition, bandit in bandits.items():
+        state = model['bandits'][condition]
+        for name in model_store.ARRAY_NAMES:
+            array = state[name]
+            assert isinstance(array, np.memmap)
+            assert not array.flags.writeable
+            np.testing.assert_array_equal(array, bandit.__getstate__()[name])
+        with pytest.raises(ValueError):
+            state['mu'][0] = 1.0
+    # The lazy decay scale is folded into the saved B
+    loaded = load_bandits(path)['adhd']
+    np.testing.assert_allclose(loaded.B, bandits['adhd'].__getstate__()['B'])
+    np.testing.assert_allclose(loaded.mu, bandits['adhd'].mu)
+
+
+def test_read_header_rejects_other_files(tmp_path):
+    path = tmp_path / "model.bin"
+    path.write_bytes(b"not a model file")
+    with pytest.raises(ValueError, match="not a TheraMuse model"):
+        model_store.read_header(path)
+
+    save_model(path, {'adhd': LinearThompsonSampling(2)})
+    data = bytearray(path.read_bytes())
+    header_len = model_store._PREFIX.unpack_from(data)[1]
+    header = json.loads(data[model_store._PREFIX.size:model_store._PREFIX.size + header_len])
+    header['version'] = model_store.FORMAT_VERSION + 1
+    future = json.dumps(header).encode('utf-8')
+    path.write_bytes(model_store._PREFIX.pack(model_store.MAGIC, len(future)) + future)
+    with pytest.raises(ValueError, match="Unsupported model format version"):
+        model_store.read_header(path)
+
+
+def test_convert_the_shipped_pickle(tmp_path):
+    shipped = model_store.Path(__file__).resolve().parent.parent / "theramuse_model.pkl"
+    with open(shipped, 'rb') as fh:
+        legacy = model_store._LegacyModelUnpickler(fh).load()
+
+    out = model_store.convert_pickle(str(shipped), str(tmp_path / "model.bin"))
+    model = load_model(out)
+    assert model['exploration_rate'] == legacy['exploration_rate']
+    assert model['saved_at'] == legacy['saved_at']
+    assert sorted(model['bandits']) == sorted(legacy['bandits']) == ['adhd', 'dementia', 'down_syndrome']
+    for condition, old in legacy['bandits'].items():
+        state = model['bandits'][condition]
+        assert state['n_interactions'] == old.n_interactions
+        for name in model_store.ARRAY_NAMES:
+            np.testing.assert_array_equal(state[name], getattr(old, name))
+
+
+def test_legacy_unpickler_refuses_other_globals(tmp_path):
+    with pytest.raises(pickle.UnpicklingError, match="Refusing to load posix.system|Refusing to load os.system"):
+        model_store._LegacyModelUnpickler(io.BytesIO(b"cos\nsystem\n(S'true'\ntR.")).load()
+    with pytest.raises(pickle.UnpicklingError, match="Refusing to load builtins.eval"):
+        model_store._LegacyModelUnpickler(io.BytesIO(pickle.dumps(eval))).load()
+
+
+def test_legacy_pickle_round_trips_through_the_restricted_unpickler(tmp_path):
+    path = tmp_path / "theramuse_model.pkl"
+    bandit = LinearThompsonSampling(3)
+    bandit.update(np.ones(3), 1.0)
+    model_store.save_legacy_pickle(path, {'adhd': bandit}, exploration_rate=0.3, saved_at='then')
+    with open(path, 'rb') as fh:
+        loaded = model_store._LegacyModelUnpickler(fh).load()
+    assert loaded['exploration_rate'] == 0.3 and loaded['saved_at'] == 'then'
+    adhd = loaded['bandits']['adhd']
+    assert isinstance(adhd, model_store._LegacyBandit)
+    assert adhd.n_interactions == 1
+    np.testing.assert_allclose(adhd.B, bandit.B)
+
+
+def test_windowed_rebuild_only_uses_recent_feedback(tmp_path):
+    db = tmp_path / "theramuse.db"
+    migrate(db)
+    rng = np.random.default_rng(4)
+    conn = sqlite3.connect(db)
+    conn.executemany(
+        "INSERT INTO therapy_feedback (patient_id, condition, reward, context_features, created_at) "
+        "VALUES (?, ?, ?, ?, ?)",
+        [('p1', condition, 1.0, json.dumps(rng.random(20).tolist()), created_at)
+         for condition, created_at in [('adhd', '2000-01-01 00:00:00'), ('adhd', '2999-01-01 00:00:00'),
+                                       ('dementia', '2000-01-01 00:00:00'), ('autism', '2999-01-01 00:00:00')]])
+    conn.commit()
+    conn.close()
+
+    recent = model_store.rebuild_from_feedback(str(db), window_days=30)
+    assert {c: b.n_interactions for c, b in recent.items()} == {
+        'adhd': 1, 'autism': 1, 'dementia': 0, 'down_syndrome': 0}
+    everything = model_store.rebuild_from_feedback(str(db))
+    assert everything['adhd'].n_interactions == 2 and everything['dementia'].n_interactions == 1
@@ -0,0 +1,22 @@
+import time
+
+from rate_limiter import INTERACTIVE, REFRESH, TokenBucketLimiter
+
+
+def test_acquire_behind_a_waiting_higher_class_times_out_at_its_deadline():
+    limiter = TokenBucketLimiter(rate=10.0, burst=20)
+    # Tokens are available, but an interactive request is queued ahead
+    with limiter._cond:
+        limiter._waiting[INTERACTIVE] += 1
+    start = time.monotonic()
+    assert not limiter.acquire(REFRESH, timeout=0.2)
+    assert 0.2 <= time.monotonic() - start < 1.0
+    assert limiter.status()['rejected']['refresh'] == 1
+
+
+def test_acquire_without_rate_times_out_at_its_deadline():
+    limiter = TokenBucketLimiter(rate=0.0, burst=1)
+    assert limiter.acquire(INTERACTIVE, timeout=0.1)
+    start = time.monotonic()
+    assert not limiter.acquire(INTERACTIVE, timeout=0.2)
+    assert 0.2 <= time.monotonic() - start < 1.0
@@ -0,0 +1,95 @@
+import json
+
+import pytest
+
+import search_cache
+from search_cache import SearchCache
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(search_cache.time, 'time', clock.time)
+    return clock
+
+
+@pytest.fixture
+def cache(tmp_path, clock):
+    cache = SearchCache(str(tmp_path / "cache.db"), ttl_seconds=100, stale_seconds=50)
+    yield cache
+    cache.close()
+
+
+def songs(n, prefix='song'):
+    return [{'title': f'{prefix} {i}', 'video_id': f'{prefix}{i}'} for i in range(n)]
+
+
+def test_entries_go_stale_then_expire(cache, clock):
+    cache.set('Jazz music', songs(3))
+    assert cache.lookup('jazz   MUSIC') == (songs(3), True)
+
+    clock.now += 100
+    assert cache.lookup('jazz music') == (songs(3), False)
+    assert cache.get('jazz music') is None
+
+    clock.now += 50
+    assert cache.lookup('jazz music') == (None, False)
+    stats = cache.stats()
+    assert (stats['hits'], stats['stale_hits'], stats['misses'], stats['expirations']) == (1, 1, 2, 1)
+    assert stats['cache_size'] == 0
+
+
+def test_smaller_cached_result_is_a_miss(cache):
+    cache.set('rock music', songs(3), max_results=5)
+    # The upstream only had three results for five: that answers any request
+    assert cache.lookup('rock music', 10) == (songs(3), True)
+
+    cache.set('pop music', songs(3), max_results=3)
+    assert cache.lookup('pop music', 5) == (None, False)
+    assert not cache.contains('pop music', 5)
+    assert cache.lookup('pop music', 2) == (songs(2), True)
+    assert cache.stats()['misses'] == 1
+
+
+def test_lru_eviction_by_byte_budget(tmp_path, clock):
+    entry_size = len(json.dumps(songs(2, 'a')).encode('utf-8'))
+    cache = SearchCache(str(tmp_path / "cache.db"), max_bytes=2 * entry_size)
+    try:
+        cache.set('a', songs(2, 'a'))
+        clock.now += 1
+        cache.set('b', songs(2, 'b'))
+        clock.now += 1
+        # Touch a, so b is now the least recently used
+        assert cache.get('a') is not None
+        clock.now += 1
+        cache.set('c', songs(2, 'c'))
+
+        assert cache.get('b') is None
+        assert cache.get('a') is not None and cache.get('c') is not None
+        stats = cache.stats()
+        assert stats['evictions'] == 1
+        assert stats['cache_bytes'] <= 2 * entry_size
+    finally:
+        cache.close()
+
+
+def test_purge_expired_only_removes_entries_past_the_stale_window(cache, clock):
+    cache.set('old', songs(1))
+    clock.now += 120
+    cache.set('stale', songs(1), ttl_seconds=10)
+    cache.set('fresh', songs(1))
+    clock.now += 40
+
+    assert cache.purge_expired() == 1
+    assert cache.lookup('old') == (None, False)
+    assert cache.lookup('stale') == (songs(1), False)
+    assert cache.lookup('fresh') == (songs(1), True)
+    assert cache.stats()['expirations'] == 1
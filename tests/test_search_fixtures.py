@@ -0,0 +1,48 @@
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import pytest
+import requests
+
+from search_fixtures import REPLAY_DIR_ENV, FixtureStore, ReplayAdapter, ReplayPlan, make_handler, \
+    mount_fixture_adapter
+
+
+def test_replay_plan_from_env():
+    plan = ReplayPlan.from_env({
+        'YOUTUBE_SEARCH_REPLAY_LATENCY': '0.25',
+        'YOUTUBE_SEARCH_REPLAY_ERROR_RATE': '0.1',
+        'YOUTUBE_SEARCH_REPLAY_ERROR_STATUS': '429',
+        'YOUTUBE_SEARCH_REPLAY_TIMEOUT_RATE': '0.05',
+        'YOUTUBE_SEARCH_REPLAY_SEED': '7',
+    })
+    assert (plan.latency, plan.latency_scale, plan.error_rate, plan.error_status, plan.timeout_rate) == \
+        (0.25, 1.0, 0.1, 429, 0.05)
+    with pytest.raises(ValueError):
+        ReplayPlan.from_env({'YOUTUBE_SEARCH_REPLAY_ERROR_RATE': 'often'})
+
+
+def test_mounted_replay_adapter_uses_env_plan(tmp_path, monkeypatch):
+    monkeypatch.setenv(REPLAY_DIR_ENV, str(tmp_path))
+    monkeypatch.setenv('YOUTUBE_SEARCH_REPLAY_ERROR_RATE', '1')
+    monkeypatch.setenv('YOUTUBE_SEARCH_REPLAY_ERROR_STATUS', '429')
+    session = mount_fixture_adapter(requests.Session())
+    adapter = session.get_adapter('https://proxy.test/')
+    assert isinstance(adapter, ReplayAdapter)
+    response = session.get('https://proxy.test/', params={'q': 'rain', 'max_results': 5}, timeout=(1, 1))
+    assert response.status_code == 429
+
+
+def test_server_timeout_fault_holds_the_connection_open(tmp_path):
+    plan = ReplayPlan(timeout_rate=1.0, hang=5.0)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(FixtureStore(str(tmp_path)), plan))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        start = time.perf_counter()
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            requests.get(f"http://127.0.0.1:{server.server_port}/", params={'q': 'rain'}, timeout=(1, 0.5))
+        assert time.perf_counter() - start >= 0.5
+    finally:
+        server.shutdown()
+        server.server_close()
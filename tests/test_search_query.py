@@ -0,0 +1,34 @@
+import pytest
+
+from search_query import canonical_query
+
+
+@pytest.mark.parametrize('query, expected', [
+    # NFKC folds the full-width letters, casefold the German sharp s
+    ('ＪＡＺＺ Straße song', 'jazz strasse song'),
+    ('  1990-2010\tDhaka \n song  ', '1990-2010 dhaka song'),
+    ('Disco song.', 'disco song'),
+    ('relaxing music!;', 'relaxing music'),
+    (' Rock,Jazz ,  Pop music', 'jazz, pop, rock music'),
+    ('Best Classical Fusion, Bengali Folk songs', 'best bengali folk, classical fusion songs'),
+    # Not a genre list: left in order
+    ('Tagore, Nazrul songs', 'tagore, nazrul songs'),
+])
+def test_canonical_query(query, expected):
+    assert canonical_query(query) == expected
+
+
+def test_place_aliases_only_apply_to_place_categories():
+    assert canonical_query('1983-2003 Dacca song', 'birthplace_city') == '1983-2003 dhaka song'
+    assert canonical_query('Bangla Desh song', 'birthplace_country') == 'bangladesh song'
+    assert canonical_query('1983-2003 Dacca song') == '1983-2003 dacca song'
+
+
+@pytest.mark.parametrize('category', [None, 'favorite_musician'])
+def test_musician_names_are_not_rewritten(category):
+    assert canonical_query('Bombay Jayashri', category) == 'bombay jayashri'
+    assert canonical_query('Bd. Ashraf song', category) == 'bd. ashraf song'
+
+
+def test_bd_is_not_an_alias():
+    assert canonical_query('BD song', 'birthplace_country') == 'bd song'
@@ -0,0 +1,149 @@
+import threading
+import time
+
+import numpy as np
+
+import bandit
+from shared_model import ReadWriteLock, SharedTheraMuse, _adopt_bandits
+
+
+class LegacyBandit:
+    """Pickled backend bandit: same state as bandit.LinearThompsonSampling, no extra methods"""
+
+    def __init__(self, n_features):
+        self.n_features = n_features
+        self.alpha = 1.0
+        self.lambda_reg = 1.0
+        self.B = np.eye(n_features)
+        self.mu = np.zeros(n_features)
+        self.f = np.zeros(n_features)
+        self.n_interactions = 0
+        self.total_reward = 0.0
+
+    def update(self, context, reward):
+        pass
+
+
+class OddBandit(LegacyBandit):
+    def explain(self):
+        pass
+
+
+class FakeModel:
+    """TheraMuse stand-in whose recommendations block until released"""
+
+    def __init__(self, bandits):
+        self.bandits = bandits
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.feedback = []
+        self.cleared = 0
+
+    def get_therapy_recommendations(self, patient_id):
+        self.started.set()
+        self.release.wait(10)
+        return [patient_id]
+
+    def get_youtube_cache_status(self):
+        return {'cache_size': 0}
+
+    def clear_youtube_cache(self):
+        self.cleared += 1
+
+    def record_feedback(self, patient_id, reward):
+        if reward is None:
+            raise ValueError("missing reward")
+        self.feedback.append((patient_id, reward))
+
+
+def run(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_read_write_lock_prefers_waiting_writers():
+    lock = ReadWriteLock()
+    events = []
+    second_reader_in = threading.Event()
+    leave = threading.Event()
+
+    def hold_read():
+        with lock.read():
+            second_reader_in.set()
+            leave.wait(10)
+
+    def write():
+        with lock.write():
+            events.append('write')
+
+    def read():
+        with lock.read():
+            events.append('read')
+
+    with lock.read():
+        # Readers share the lock
+        reader = run(hold_read)
+        assert second_reader_in.wait(1)
+        writer = run(write)
+        time.sleep(0.1)
+        late_reader = run(read)
+        time.sleep(0.1)
+        # The writer waits for both readers, and the late reader waits behind the writer
+        assert events == []
+    leave.set()
+    for thread in (reader, writer, late_reader):
+        thread.join(1)
+    assert events == ['write', 'read']
+
+
+def test_adopt_bandits_only_swaps_bandits_with_matching_methods():
+    model = FakeModel({'dementia': LegacyBandit(4), 'adhd': OddBandit(4)})
+    assert not _adopt_bandits(model)
+    assert isinstance(model.bandits['dementia'], bandit.LinearThompsonSampling)
+    assert type(model.bandits['adhd']) is OddBandit
+
+    model = FakeModel({'dementia': LegacyBandit(4)})
+    assert _adopt_bandits(model)
+
+
+def test_cache_clear_and_feedback_do_not_wait_for_a_running_intake():
+    model = FakeModel({'dementia': LegacyBandit(4)})
+    shared = SharedTheraMuse(model)
+    intake = run(shared.get_therapy_recommendations, 'p1')
+    assert model.started.wait(1)
+
+    start = time.monotonic()
+    shared.clear_youtube_cache()
+    assert shared.get_youtube_cache_status() == {'cache_size': 0}
+    shared.record_feedback('p1', 1.0)
+    assert time.monotonic() - start < 0.5
+    assert model.cleared == 1 and model.feedback == [('p1', 1.0)]
+    assert intake.is_alive()
+
+    model.release.set()
+    intake.join(1)
+    assert not intake.is_alive()
+
+
+def test_feedback_waits_for_reads_when_a_bandit_was_not_adopted():
+    model = FakeModel({'adhd': OddBandit(4)})
+    shared = SharedTheraMuse(model)
+    intake = run(shared.get_therapy_recommendations, 'p1')
+    assert model.started.wait(1)
+
+    writer = run(shared.record_feedback, 'p1', 1.0)
+    writer.join(0.2)
+    assert writer.is_alive() and model.feedback == []
+
+    model.release.set()
+    writer.join(1)
+    assert model.feedback == [('p1', 1.0)]
+
+
+def test_feedback_batch_reports_failures_and_records_the_rest():
+    model = FakeModel({})
+    shared = SharedTheraMuse(model)
+    failures = shared.record_feedback_batch([('p1', 1.0), ('p2', None), ('p3', 0.0)])
+    assert failures == [(('p2', None), 'missing reward')]
+    assert model.feedback == [('p1', 1.0), ('p3', 0.0)]
@@ -0,0 +1,233 @@
+import threading
+import time
+
+import pytest
+import requests
+
+import search_cache
+from rate_limiter import TokenBucketLimiter
+from search_cache import SearchCache
+from youtube_search import CircuitBreaker, YouTubeSearchClient, create_http_session
+
+
+class StubResponse:
+    def __init__(self, results, status_code=200):
+        self.status_code = status_code
+        self.headers = {}
+        self._results = results
+
+    def json(self):
+        return {'results': self._results}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+    def close(self):
+        pass
+
+
+class StubSession:
+    """requests.Session stand-in answering every query with max_results items"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, timeout=None):
+        with self._lock:
+            self.calls.append(params['q'])
+        time.sleep(self.delay)
+        return StubResponse([{'title': f"{params['q']} {i}"} for i in range(int(params['max_results']))])
+
+
+class DeadlineSession(StubSession):
+    """Session whose calls take ``delays[query]`` seconds, cut short by the read timeout like requests'"""
+
+    def __init__(self, delays):
+        super().__init__()
+        self.delays = delays
+        self.timeouts = []
+
+    def get(self, url, params=None, timeout=None):
+        with self._lock:
+            self.timeouts.append(timeout)
+        delay = self.delays.get(params['q'], 0.0)
+        if delay > timeout[1]:
+            time.sleep(timeout[1])
+            raise requests.exceptions.ReadTimeout(f"read timed out for '{params['q']}'")
+        return super().get(url, params, timeout)
+
+
+class StubFallback:
+    def search(self, query, max_results=5):
+        return [{'title': f"{query} fallback", 'source': 'fallback'}]
+
+
+@pytest.fixture
+def make_client(tmp_path):
+    clients = []
+
+    def make(**kwargs):
+        kwargs.setdefault('session', StubSession())
+        kwargs.setdefault('limiter', TokenBucketLimiter())
+        client = YouTubeSearchClient('http://proxy.test/', cache=SearchCache(str(tmp_path / f"c{len(clients)}.db")),
+                                     **kwargs)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.close()
+
+
+def test_interactive_search_does_not_wait_behind_queued_prefetch(make_client):
+    limiter = TokenBucketLimiter(rate=0.2, burst=2)
+    limiter._tokens = 1.5
+    client = make_client(limiter=limiter, timeout=2.0)
+    query = '1990-2010 Dhaka song'
+
+    # The prefetch needs 1 token plus the background reserve of 1, so it queues
+    prefetch = threading.Thread(target=client.prefetch, args=(query,), daemon=True)
+    prefetch.start()
+    time.sleep(0.2)
+
+    start = time.monotonic()
+    results = client.search(query)
+    assert len(results) == 5
+    assert time.monotonic() - start < 1.0
+
+    # Let the queued prefetch finish quickly
+    with limiter._cond:
+        limiter.rate = 1000.0
+        limiter._cond.notify_all()
+    prefetch.join(10)
+
+
+def test_sessions_leave_retries_to_the_client():
+    for scheme in ('https://', 'http://'):
+        assert create_http_session().get_adapter(scheme).max_retries.total == 0
+
+
+def test_search_many_shares_one_deadline_and_falls_back_for_late_categories(make_client):
+    session = DeadlineSession({'slow song': 5.0, 'slower song': 10.0})
+    client = make_client(session=session, fallback=StubFallback(), timeout=10.0, retries=0)
+
+    start = time.monotonic()
+    results = client.search_many({'fast': 'fast song', 'slow': 'slow song', 'slower': 'slower song'},
+                                 timeout=0.5)
+    elapsed = time.monotonic() - start
+
+    assert elapsed < 1.0
+    assert [song['title'] for song in results['fast']] == [f'fast song {i}' for i in range(5)]
+    for category in ('slow', 'slower'):
+        assert results[category] == [{'title': f"{category} song fallback", 'source': 'fallback'}]
+
+    # The upstream calls got the time left before the shared deadline, not the client timeout
+    assert len(session.timeouts) == 3
+    assert all(read <= 0.5 for _, read in session.timeouts)
+    # so the abandoned searches end by the deadline and free their workers
+    client._executor.shutdown(wait=True)
+    assert time.monotonic() - start < 1.0
+
+
+def test_concurrent_equivalent_searches_share_one_upstream_call(make_client):
+    session = StubSession(delay=0.5)
+    client = make_client(session=session)
+    queries = ['Jazz music', 'jazz   music', 'JAZZ Music', ' jazz music ', 'ｊａｚｚ music', 'jazz MUSIC']
+    barrier = threading.Barrier(len(queries))
+    results = [None] * len(queries)
+
+    def search(i):
+        barrier.wait()
+        results[i] = client.search(queries[i])
+
+    threads = [threading.Thread(target=search, args=(i,)) for i in range(len(queries))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(session.calls) == 1
+    assert client.status()['coalesced_requests'] == len(queries) - 1
+    assert all(result == results[0] for result in results)
+    assert len(results[0]) == 5
+
+
+class GatedSession(StubSession):
+    """Answers with the current version's titles; calls block until ``gate`` is set"""
+
+    def __init__(self):
+        super().__init__()
+        self.version = 1
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def get(self, url, params=None, timeout=None):
+        self.gate.wait(10)
+        with self._lock:
+            self.calls.append(params['q'])
+        return StubResponse([{'title': f"v{self.version} {i}"} for i in range(int(params['max_results']))])
+
+
+def test_stale_results_are_served_while_one_refresh_runs(make_client, monkeypatch):
+    now = [time.time()]
+    monkeypatch.setattr(search_cache.time, 'time', lambda: now[0])
+    session = GatedSession()
+    client = make_client(session=session, category_ttls={'calm': 60})
+    first = client.search('calm music', category='calm')
+    assert first[0]['title'] == 'v1 0'
+
+    # Past the category TTL but well inside the stale window
+    now[0] += 61
+    session.version = 2
+    session.gate.clear()
+    start = time.monotonic()
+    for _ in range(3):
+        assert client.search('Calm  music', category='calm') == first
+    assert time.monotonic() - start < 0.5
+    status = client.status()
+    assert status['stale_served'] == 3
+    assert status['pending_refreshes'] == 1
+
+    session.gate.set()
+    client._refresh_executor.shutdown(wait=True)
+    assert client.status()['refreshes'] == 1
+    assert len(session.calls) == 2
+    assert client.cache.lookup('calm music', 5) == ([{'title': f'v2 {i}'} for i in range(5)], True)
+    assert client.search('calm music', category='calm')[0]['title'] == 'v2 0'
+    assert len(session.calls) == 2
+
+
+def test_circuit_breaker_opens_probes_and_closes_or_reopens():
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=30.0, clock=lambda: now[0])
+
+    for _ in range(2):
+        assert breaker.allow()
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    # One probe after the reset timeout; a failed probe reopens for another timeout
+    now[0] += 30.0
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    now[0] += 29.0
+    assert not breaker.allow()
+
+    # An unused probe slot can be given back; a successful probe closes the circuit
+    now[0] += 1.0
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow() and breaker.allow()
+    assert breaker.status() == {'circuit_state': 'closed', 'consecutive_failures': 0, 'circuit_opened': 2}
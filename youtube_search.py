@@ -0,0 +1,586 @@
+"""Client for the TheraMuse YouTube search proxy (API_BASE_URL).
+
+Searches go through the persistent SearchCache first. ``search_many`` fans
+the per-category queries of one intake out over a bounded thread pool, so
+an intake waits for its slowest query rather than the sum of all of them.
+All clients share one keep-alive, connection-pooled requests.Session. The
+client retries connection errors, timeouts and 429/5xx responses itself,
+with jittered exponential backoff, and only while the search deadline
+(``timeout``) leaves room for another attempt. Concurrent
+misses for the same query are coalesced into a single upstream request.
+Queries are canonicalised (search_query.canonical_query) before the cache
+lookup and before being sent upstream. Expired entries are served stale
+while a background refresh fetches the new results, and each category has
+its own TTL (CATEGORY_TTLS). A circuit breaker stops calling the proxy
+after repeated failures; while it is open, misses are answered from the
+offline FallbackCatalog and a single half-open probe is let through once
+the reset timeout has passed. Only interactive searches fall back; other
+priority classes raise CircuitOpen instead. The shared session can record or replay
+proxy traffic through search_fixtures (YOUTUBE_SEARCH_RECORD_DIR /
+YOUTUBE_SEARCH_REPLAY_DIR). Upstream requests take a token from the
+upstream's rate limiter in their priority class (interactive searches,
+stale refreshes, background prefetch), interactive first.
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import requests
+import toml
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from fallback_catalog import FallbackCatalog
+from rate_limiter import (BACKGROUND, INTERACTIVE, REFRESH, RateLimitExceeded, TokenBucketLimiter,
+                          get_rate_limiter)
+from search_cache import SearchCache, normalize_query
+from search_fixtures import mount_fixture_adapter
+from search_query import canonical_query
+
+DEFAULT_MAX_RESULTS = 5
+DEFAULT_TIMEOUT = 10.0
+# Upper bounds for one attempt; shorter client timeouts scale them down
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 8.0
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+DEFAULT_BACKOFF_JITTER = 0.5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+DEFAULT_REFRESH_WORKERS = 2
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+DAY = 24 * 3600
+# Result TTL per recommendation category; other categories use the cache TTL.
+# Binaural, therapeutic raga, sensory, focus, instrument and nature queries
+# hardly change, artist queries do.
+CATEGORY_TTLS = {
+    'binaural_beats': 90 * DAY,
+    'calming_sensory': 90 * DAY,
+    'therapeutic': 90 * DAY,
+    'concentration': 60 * DAY,
+    'relief_study': 60 * DAY,
+    'additional_calm': 60 * DAY,
+    'additional_focus': 60 * DAY,
+    'natural_elements': 60 * DAY,
+    'instruments': 60 * DAY,
+    'seasonal': 30 * DAY,
+    'birthplace_country': 30 * DAY,
+    'birthplace_city': 30 * DAY,
+    'big5_scores_songs': 14 * DAY,
+    'personality_based': 14 * DAY,
+    'favorite_genre': 7 * DAY,
+    'favorite_musician': 2 * DAY,
+}
+
+_shared_session: Optional[requests.Session] = None
+_shared_session_lock = threading.Lock()
+
+
+def load_api_base_url() -> Optional[str]:
+    """Find API_BASE_URL in the environment or the Streamlit secrets/config files.
+
+    In the files the key may sit at the top level or inside a table; in
+    config.toml it follows the [theme] section and so belongs to it.
+    """
+    if os.environ.get("API_BASE_URL"):
+        return os.environ["API_BASE_URL"]
+    for path in (Path(".streamlit/secrets.toml"), Path(".streamlit/config.toml")):
+        if path.exists():
+            try:
+                data = toml.load(path)
+            except (toml.TomlDecodeError, OSError):
+                continue
+            tables = [data] + [value for value in data.values() if isinstance(value, dict)]
+            for table in tables:
+                if table.get("API_BASE_URL"):
+                    return table["API_BASE_URL"]
+    return None
+
+
+def attempt_timeouts(timeout: float) -> Tuple[float, float]:
+    """Per-attempt (connect, read) timeouts for a client timeout.
+
+    The defaults apply to long timeouts; shorter ones are scaled down so a
+    single slow attempt cannot use up the budget and leaves time for a retry.
+    """
+    return min(DEFAULT_CONNECT_TIMEOUT, timeout / 5), min(DEFAULT_READ_TIMEOUT, timeout / 2)
+
+
+def retry_budget(timeout: float, connect_timeout: float, read_timeout: float,
+                 backoff_factor: float = DEFAULT_BACKOFF_FACTOR, backoff_jitter: float = DEFAULT_BACKOFF_JITTER,
+                 max_retries: int = DEFAULT_RETRIES) -> int:
+    """Number of retries whose backoff fits in timeout next to one full-length attempt"""
+    spare = timeout - (connect_timeout + read_timeout)
+    retries = 0
+    while retries < max_retries:
+        spare -= backoff_factor * (2 ** retries) + backoff_jitter
+        if spare < 0:
+            break
+        retries += 1
+    return retries
+
+
+def create_http_session(pool_size: int = DEFAULT_MAX_WORKERS, retries: int = 0,
+                        backoff_factor: float = DEFAULT_BACKOFF_FACTOR,
+                        backoff_jitter: float = DEFAULT_BACKOFF_JITTER) -> requests.Session:
+    """Keep-alive session with a connection pool.
+
+    By default the session does not retry: YouTubeSearchClient retries
+    within each search's deadline, which a transport-level Retry cannot see.
+    ``retries`` > 0 adds 429/5xx retry with jittered backoff for callers
+    outside the client.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff_factor,
+        backoff_jitter=backoff_jitter,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({'GET'}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_shared_session() -> requests.Session:
+    """The process-wide session used by every search client"""
+    global _shared_session
+    with _shared_session_lock:
+        if _shared_session is None:
+            _shared_session = mount_fixture_adapter(create_http_session())
+        return _shared_session
+
+
+def parse_results(payload) -> List[Dict]:
+    """Normalise a proxy response into a list of result dicts"""
+    if isinstance(payload, dict):
+        for key in ('results', 'items', 'videos', 'songs'):
+            if isinstance(payload.get(key), list):
+                payload = payload[key]
+                break
+        else:
+            return []
+    if not isinstance(payload, list):
+        return []
+    return [item for item in payload if isinstance(item, dict)]
+
+
+class CircuitOpen(RuntimeError):
+    """The circuit breaker is open and the caller cannot use the fallback catalog"""
+
+
+class CircuitBreaker:
+    """Closed -> open after N consecutive failures -> half-open probe after a timeout"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.times_opened = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a request may go upstream now; in half-open only one probe may"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def release(self):
+        """Give back a half-open probe slot that was granted but not used"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self._opened_at = self._clock()
+            self._probe_in_flight = False
+
+    def status(self) -> Dict:
+        with self._lock:
+            return {
+                'circuit_state': self.state,
+                'consecutive_failures': self.failures,
+                'circuit_opened': self.times_opened,
+            }
+
+
+class YouTubeSearchClient:
+    """Cached, concurrent search client for the YouTube search proxy"""
+
+    def __init__(self, api_base_url: Optional[str] = None, cache: Optional[SearchCache] = None,
+                 timeout: float = DEFAULT_TIMEOUT, max_workers: int = DEFAULT_MAX_WORKERS,
+                 connect_timeout: Optional[float] = None, read_timeout: Optional[float] = None,
+                 retries: Optional[int] = None, session: Optional[requests.Session] = None,
+                 category_ttls: Optional[Dict[str, float]] = None,
+                 refresh_workers: int = DEFAULT_REFRESH_WORKERS,
+                 breaker: Optional[CircuitBreaker] = None,
+                 fallback: Optional[FallbackCatalog] = None,
+                 limiter: Optional[TokenBucketLimiter] = None,
+                 db_path: Optional[str] = None):
+        self.api_base_url = api_base_url or load_api_base_url()
+        self.cache = cache if cache is not None else SearchCache()
+        # timeout bounds a whole search including retries; connect/read bound each
+        # attempt and, like the retry count, are derived from it unless given
+        self.timeout = timeout
+        default_connect, default_read = attempt_timeouts(timeout)
+        self.connect_timeout = default_connect if connect_timeout is None else connect_timeout
+        self.read_timeout = default_read if read_timeout is None else read_timeout
+        self.retries = (retry_budget(timeout, self.connect_timeout, self.read_timeout)
+                        if retries is None else retries)
+        self.session = session if session is not None else get_shared_session()
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        # Without a catalog or a database path, fallback answers are empty
+        if fallback is None and db_path is not None:
+            fallback = FallbackCatalog(str(db_path))
+            fallback.preload()
+        self.fallback = fallback
+        self.limiter = limiter if limiter is not None else get_rate_limiter(self.api_base_url)
+        self.category_ttls = dict(CATEGORY_TTLS if category_ttls is None else category_ttls)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="youtube-search")
+        # Separate pool so background refreshes never delay foreground searches
+        self._refresh_executor = ThreadPoolExecutor(max_workers=refresh_workers,
+                                                    thread_name_prefix="youtube-refresh")
+        self._refreshing = set()
+        self._stats_lock = threading.Lock()
+        self._inflight: Dict[Tuple[str, int], Future] = {}
+        self._inflight_lock = threading.Lock()
+        self.requests_made = 0
+        self.retried_requests = 0
+        self.request_errors = 0
+        self.timeouts = 0
+        self.coalesced_requests = 0
+        self.stale_served = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.fallback_served = 0
+        self.rate_limited = 0
+
+    def ttl_for(self, category: Optional[str]) -> Optional[float]:
+        """Result TTL for a category (None means the cache default)"""
+        return self.category_ttls.get(category) if category else None
+
+    def _deadline(self, deadline: Optional[float]) -> float:
+        """The given time.monotonic() deadline, or one client timeout from now"""
+        return time.monotonic() + self.timeout if deadline is None else deadline
+
+    def _acquire(self, query: str, priority: int, deadline: Optional[float]) -> float:
+        """Wait for a rate limiter token; returns the deadline for the upstream call.
+
+        Interactive requests wait until the deadline, background ones as long
+        as it takes (their deadline starts once the token is granted).
+        """
+        if priority == BACKGROUND:
+            granted = self.limiter.acquire(priority, None)
+            deadline = self._deadline(deadline)
+        else:
+            deadline = self._deadline(deadline)
+            granted = self.limiter.acquire(priority, max(deadline - time.monotonic(), 0.0))
+        if not granted:
+            with self._stats_lock:
+                self.rate_limited += 1
+            self.breaker.release()
+            raise RateLimitExceeded(f"No search quota available for '{query}'")
+        if deadline <= time.monotonic():
+            self.breaker.release()
+            raise requests.exceptions.Timeout(f"Search deadline passed before '{query}' was sent")
+        return deadline
+
+    def _fetch(self, query: str, max_results: int, deadline: float) -> List[Dict]:
+        """Call the search proxy directly, reporting the outcome to the circuit breaker.
+
+        The caller already holds a rate limiter token. Each attempt's connect
+        and read timeouts are cut to the time left, so the call itself ends
+        at the deadline rather than only the caller's wait.
+        """
+        try:
+            if not self.api_base_url:
+                raise RuntimeError("API_BASE_URL is not configured")
+            response = self._get_with_retries(query, max_results, deadline)
+            response.raise_for_status()
+            results = parse_results(response.json())
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self.breaker.record_success()
+        return results
+
+    def _backoff(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        """Seconds to wait before retry number attempt + 1, honouring Retry-After"""
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        try:
+            return max(float(retry_after), 0.0)
+        except (TypeError, ValueError):
+            return DEFAULT_BACKOFF_FACTOR * (2 ** attempt) + random.uniform(0, DEFAULT_BACKOFF_JITTER)
+
+    def _get_with_retries(self, query: str, max_results: int, deadline: float) -> requests.Response:
+        """GET the proxy, retrying errors and 429/5xx while the deadline leaves time.
+
+        Every attempt's connect and read timeouts are cut to the time left,
+        and a retry is only made if its backoff ends before the deadline, so
+        the whole call finishes by the deadline.
+        """
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise requests.exceptions.Timeout(f"Search deadline passed for '{query}'")
+            with self._stats_lock:
+                self.requests_made += 1
+                if attempt:
+                    self.retried_requests += 1
+            try:
+                response = self.session.get(
+                    self.api_base_url,
+                    params={'q': query, 'max_results': max_results},
+                    timeout=(min(self.connect_timeout, remaining), min(self.read_timeout, remaining)),
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if attempt >= self.retries:
+                    raise
+                delay = self._backoff(attempt)
+                if time.monotonic() + delay >= deadline:
+                    raise
+            else:
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return response
+                delay = self._backoff(attempt, response)
+                if time.monotonic() + delay >= deadline:
+                    return response
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    def _fallback(self, query: str, max_results: int) -> List[Dict]:
+        """Answer from the offline catalog; every result has 'source': 'fallback'"""
+        with self._stats_lock:
+            self.fallback_served += 1
+        return self.fallback.search(query, max_results) if self.fallback is not None else []
+
+    def _fetch_coalesced(self, query: str, max_results: int, ttl: Optional[float] = None,
+                         priority: int = INTERACTIVE, deadline: Optional[float] = None) -> List[Dict]:
+        """Fetch and cache query; concurrent callers for the same query share one request.
+
+        A request is only shared once it holds a rate limiter token, so an
+        interactive caller never waits behind a background leader that is
+        still queued for quota. Followers wait for the leader's request only
+        until their own deadline.
+        """
+        key = (normalize_query(query), max_results)
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced_requests += 1
+
+        leader = False
+        if future is None:
+            deadline = self._acquire(query, priority, deadline)
+            with self._inflight_lock:
+                # Another caller may have been granted a token first; share its
+                # request and let this token go unused
+                future = self._inflight.get(key)
+                leader = future is None
+                if leader:
+                    future = Future()
+                    self._inflight[key] = future
+                else:
+                    self.coalesced_requests += 1
+
+        if not leader:
+            if priority == BACKGROUND:
+                return future.result()
+            try:
+                return future.result(max(self._deadline(deadline) - time.monotonic(), 0.0))
+            except FutureTimeoutError:
+                raise requests.exceptions.Timeout(f"Search deadline passed waiting for '{query}'") from None
+
+        try:
+            results = self._fetch(query, max_results, deadline)
+            self.cache.set(query, results, ttl, max_results)
+            future.set_result(results)
+            return results
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+
+    def _refresh(self, key: Tuple[str, int], ttl: Optional[float]):
+        """Background refetch of a stale entry; on failure the stale entry stays"""
+        try:
+            if not self.breaker.allow():
+                return
+            self._fetch_coalesced(key[0], key[1], ttl, REFRESH)
+            with self._stats_lock:
+                self.refreshes += 1
+        except Exception as e:
+            with self._stats_lock:
+                self.refresh_errors += 1
+            print(f"Background refresh failed for '{key[0]}': {str(e)}")
+        finally:
+            with self._inflight_lock:
+                self._refreshing.discard(key)
+
+    def _schedule_refresh(self, query: str, max_results: int, ttl: Optional[float]):
+        """Queue one background refresh per stale query"""
+        key = (normalize_query(query), max_results)
+        with self._inflight_lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        try:
+            self._refresh_executor.submit(self._refresh, key, ttl)
+        except RuntimeError:
+            # Executor already shut down
+            with self._inflight_lock:
+                self._refreshing.discard(key)
+
+    def search(self, query: str, max_results: int = DEFAULT_MAX_RESULTS,
+               category: Optional[str] = None, priority: int = INTERACTIVE,
+               deadline: Optional[float] = None) -> List[Dict]:
+        """Search one query, serving from the cache when possible.
+
+        A stale cached result is returned immediately and refreshed in the
+        background; only true misses wait on the network. While the circuit
+        breaker is open, interactive misses are answered from the fallback
+        catalog and other priorities raise CircuitOpen.
+        priority is the rate limiter class (INTERACTIVE, REFRESH, BACKGROUND);
+        deadline is a time.monotonic() value after which the upstream call is
+        abandoned (one client timeout from now by default).
+        """
+        query = canonical_query(query, category)
+        ttl = self.ttl_for(category)
+        cached, fresh = self.cache.lookup(query, max_results)
+        if cached is not None:
+            if not fresh:
+                with self._stats_lock:
+                    self.stale_served += 1
+                self._schedule_refresh(query, max_results, ttl)
+            return cached
+        if not self.breaker.allow():
+            if priority != INTERACTIVE:
+                raise CircuitOpen(f"Search proxy circuit is open, not searching '{query}'")
+            return self._fallback(query, max_results)
+        return self._fetch_coalesced(query, max_results, ttl, priority, deadline)
+
+    def prefetch(self, query: str, max_results: int = DEFAULT_MAX_RESULTS,
+                 category: Optional[str] = None) -> List[Dict]:
+        """Fetch query into the cache now, in the BACKGROUND rate limiter class.
+
+        Unlike search(), never answers from a stale entry or the fallback
+        catalog: it raises if the circuit breaker is open or the fetch fails.
+        """
+        query = canonical_query(query, category)
+        if not self.breaker.allow():
+            raise CircuitOpen(f"Search proxy circuit is open, not prefetching '{query}'")
+        return self._fetch_coalesced(query, max_results, self.ttl_for(category), BACKGROUND)
+
+    def _search_or_fallback(self, query: str, max_results: int, category: Optional[str] = None,
+                            deadline: Optional[float] = None) -> List[Dict]:
+        """search() that answers from the offline catalog instead of raising"""
+        try:
+            return self.search(query, max_results, category, deadline=deadline)
+        except Exception as e:
+            with self._stats_lock:
+                self.request_errors += 1
+            print(f"YouTube search failed for '{query}': {str(e)}")
+            return self._fallback(query, max_results)
+
+    def search_many(self, queries: Dict[str, str], max_results: int = DEFAULT_MAX_RESULTS,
+                    timeout: Optional[float] = None) -> Dict[str, List[Dict]]:
+        """Run one search per category concurrently.
+
+        Every query gets at most ``timeout`` seconds (the client timeout by
+        default). The deadline is passed down to the upstream calls, so
+        searches still running at that point are abandoned and free their
+        workers; categories whose query failed or did not finish in time are
+        answered from the fallback catalog.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        futures = {
+            category: self._executor.submit(self._search_or_fallback, query, max_results, category, deadline)
+            for category, query in queries.items()
+        }
+        wait(futures.values(), timeout=timeout)
+
+        results = {}
+        for category, future in futures.items():
+            if future.done():
+                results[category] = future.result()
+            else:
+                future.cancel()
+                with self._stats_lock:
+                    self.timeouts += 1
+                results[category] = self._fallback(queries[category], max_results)
+        return results
+
+    def status(self) -> Dict:
+        """Cache statistics plus request counters"""
+        status = self.cache.stats()
+        status.update({
+            'api_base_url': self.api_base_url,
+            'requests_made': self.requests_made,
+            'retried_requests': self.retried_requests,
+            'request_errors': self.request_errors,
+            'timeouts': self.timeouts,
+            'coalesced_requests': self.coalesced_requests,
+            'stale_served': self.stale_served,
+            'refreshes': self.refreshes,
+            'refresh_errors': self.refresh_errors,
+            'pending_refreshes': len(self._refreshing),
+            'fallback_served': self.fallback_served,
+            'rate_limited': self.rate_limited,
+            'rate_limiter': self.limiter.status(),
+        })
+        status.update(self.breaker.status())
+        return status
+
+    def close(self):
+        """Drop queued searches and refreshes, wait for running ones, then close the cache"""
+        # Running work ends by its deadline and still writes to the cache
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._refresh_executor.shutdown(wait=True, cancel_futures=True)
+        self.cache.close()